@@ -1,8 +1,56 @@
 """ This class prints and parses command line arguments. """
 
 import argparse
+import re
+from datetime import date, timedelta
 from os import getenv
 
+from taglines import keyword_expression
+
+
+def _keyword_expression(value):
+    """ Check that value is a valid keyword expression. """
+
+    try:
+        keyword_expression.parse(value)
+    except keyword_expression.ParseError as error:
+        raise argparse.ArgumentTypeError(str(error)) from error
+    return value
+
+
+def _date(value):
+    """ Convert a date in ISO format or a number of days ago, like 30d, to
+    ISO format. """
+
+    match = re.fullmatch(r"(\d+)d", value)
+    if match:
+        return (date.today() - timedelta(days=int(match.group(1)))).isoformat()
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(
+            f"invalid date '{value}', expected YYYY-MM-DD or a number of "
+            "days like 30d") from error
+
+
+def _template(value):
+    """ Replace the escapes \\n, \\t and \\\\ in an output template and check
+    its fields. """
+
+    # imported here, so that a random tagline from a snapshot does not load
+    # sqlite3
+    from taglines.database import TaglineRecord
+
+    value = re.sub(r"\\([nt\\])", lambda match: {"n": "\n", "t": "\t"}.get(
+        match.group(1), "\\"), value)
+    try:
+        TaglineRecord((None,) * 7).format(value)
+    except (KeyError, IndexError, ValueError, AttributeError,
+            TypeError) as error:
+        raise argparse.ArgumentTypeError(
+            f"invalid template: {error}") from error
+    return value
+
 
 def parse_arguments():
     """ Parse arguments passed to Taglines. """
@@ -18,6 +66,14 @@ def parse_arguments():
     group.add_argument(
         '-r', '--random', action='store_true',
         help='From the found items, show one at random (default)')
+    group.add_argument(
+        '--count', action='store_true',
+        help='Print the number of found texts and of their taglines, '
+             'separated by a tab')
+    group.add_argument(
+        '--count-by', choices=['language', 'keyword'],
+        help='Print the number of found texts and of their taglines for each '
+             'language or keyword, preceded by its name')
     group.add_argument(
         '--show-keywords', action='store_true',
         help='List all available keywords in the database and exit')
@@ -27,23 +83,100 @@ def parse_arguments():
     group.add_argument(
         '--stats', action='store_true',
         help='Show some statistics about the database')
+    group.add_argument(
+        '--find-duplicates', action='store_true',
+        help='List all texts that occur more than once')
+    group.add_argument(
+        '--find-near-duplicates', action='store_true',
+        help='List groups of taglines with nearly the same text, see '
+             '--similarity')
+    group.add_argument(
+        '--compile-snapshot', action='store_true',
+        help='Write a compact read-only snapshot of the database for fast '
+             'random selection. Unless --snapshot-out is given, it is written '
+             'next to the database file, where -r uses it while it is newer '
+             'than the database')
+    group.add_argument(
+        '--backup', metavar='DEST',
+        help='Write a consistent copy of the database to DEST while it is in '
+             'use')
+    group.add_argument(
+        '--export-changes', type=int, metavar='SINCE',
+        help='Write all changes after change number SINCE to stdout, to be '
+             'applied to a copy of the database with --apply-changes')
+    group.add_argument(
+        '--apply-changes', metavar='FILE',
+        help='Apply changes written by --export-changes ("-" for stdin)')
+    group.add_argument(
+        '--batch', metavar='FILE',
+        help='Apply a script of operations in newline-delimited JSON ("-" '
+             'for stdin) in one transaction: add, edit and delete taglines, '
+             'set their author or keywords')
+    group.add_argument(
+        '--maintain', action='store_true',
+        help='Remove rows which refer to deleted taglines, keywords or '
+             'authors, and update the statistics of the query planner')
+    group.add_argument(
+        '--compress-texts', action='store_true',
+        help='Store the texts compressed with a dictionary trained from them '
+             '(zstd if available, else zlib), from now on and for all '
+             'existing texts, and report the size and reading speed')
+    group.add_argument(
+        '--decompress-texts', action='store_true',
+        help='Store all texts uncompressed again')
     group.add_argument(
         '--init', action='store_true',
         help='Initialise a new database file')
     group.add_argument(
         '-i', '--interactive', action='store_true',
         help='Go into interactive mode (simple shell)')
+    group.add_argument(
+        '--import', action='append', metavar='FILE', dest='import_files',
+        help='Import a fortune file or mbox signatures as new taglines; '
+             'repeat the option for several files. The language is given by '
+             '-l, author and keywords by -a and -k')
     parser.add_argument(
         '-E', '--editor', default=getenv('EDITOR'),
         help='External editor to use. Default taken from environment, set to '
              '"-" to disable external editor. May contain arguments to editor, '
              'e.g. "vim -X."')
+    parser.add_argument(
+        '--similarity', type=float, default=0.7,
+        help='The similarity between 0 and 1 from which '
+             '--find-near-duplicates considers texts nearly the same '
+             '(default: 0.7)')
+    parser.add_argument(
+        '--snapshot-out', metavar='OUT',
+        help='Write the snapshot of --compile-snapshot to OUT')
+    parser.add_argument(
+        '--compress', action='store_true',
+        help='Compress the --backup copy with gzip')
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='Check the --backup copy with an integrity check')
+    parser.add_argument(
+        '--vacuum', action='store_true',
+        help='Let --maintain also release free space to the file system')
+    parser.add_argument(
+        '--in-memory', action='store_true',
+        help='Load the database into memory for -i, --import, --batch, '
+             '--maintain and --apply-changes and write it back to the file on '
+             'every commit, unless another program has changed the file in '
+             'between')
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='Number of worker processes for --import (default: all cores)')
     parser.add_argument(
         '-o', '--orkeyword', action='store_true',
         help='Combine several keywords with OR instead of AND')
     parser.add_argument(
         '-k', '--keyword', action='append',
         help='Only show items with the given keyword(s)')
+    parser.add_argument(
+        '-w', '--where-keywords', type=_keyword_expression, metavar='EXPR',
+        help='Only show items whose keywords match a boolean expression of '
+             'AND, OR, NOT and parentheses, e.g. "(linux OR unix) AND NOT '
+             'politics". Quote keywords containing spaces with ""')
     parser.add_argument(
         '-t', '--text', action='append',
         help='Search for given text (combined with AND. Only a word: search as '
@@ -57,22 +190,72 @@ def parse_arguments():
         help='Look for exact author match')
     parser.add_argument(
         '-l', '--lang',
-        help='Only show items with the given language')
+        help='Only show items with the given language. A comma separated '
+             'list gives an order of preference, of which only the best '
+             'available translation of each tagline is shown. Use * for any '
+             'other language, e.g. "en,de,*"')
+    parser.add_argument(
+        '--max-lines', type=int, metavar='N',
+        help='Only show items with at most N lines')
+    parser.add_argument(
+        '--max-width', type=int, metavar='N',
+        help='Only show items whose lines are at most N columns wide')
+    parser.add_argument(
+        '--max-chars', type=int, metavar='N',
+        help='Only show items with at most N characters')
+    parser.add_argument(
+        '--added-since', type=_date, metavar='DATE',
+        help='Only show texts added or changed on or after DATE (YYYY-MM-DD, '
+             'or a number of days ago like 30d)')
+    parser.add_argument(
+        '--added-until', type=_date, metavar='DATE',
+        help='Only show texts added or changed on or before DATE')
+    parser.add_argument(
+        '--dated-since', type=_date, metavar='DATE',
+        help='Only show taglines whose date of origin is on or after DATE')
+    parser.add_argument(
+        '--dated-until', type=_date, metavar='DATE',
+        help='Only show taglines whose date of origin is on or before DATE')
+    parser.add_argument(
+        '--new', action='store_true',
+        help='Only show texts added since the last run of -L with --new and '
+             'the same selectors, which then remembers the newest text for '
+             'the next run')
+    parser.add_argument(
+        '--template', type=_template,
+        help='Output format of -r and -L, with the fields {text}, {author}, '
+             '{source}, {remark}, {date}, {language} and {keywords}, e.g. '
+             '"{text}\\n  -- {author}, {source}"')
     parser.add_argument(
         '-s', '--sort', choices=['a', 'l', 't'],
         help='Sort output by author, language or text')
     parser.add_argument(
-        'file',
-        help='An sqlite3 database file')
+        'file', nargs='+',
+        help='An sqlite3 database file. -r, -L, --count(-by), --stats, '
+             '--show-keywords and --show-authors accept several files and '
+             'combine their content')
     #group=parser.add_argument_group('Actions')
     #group=parser.add_mutually_exclusive_group()
 
     args = parser.parse_args()
     if not any(
         (
-            args.list, args.random, args.show_keywords, args.show_authors,
-            args.stats, args.init, args.interactive)
+            args.list, args.random, args.count, args.count_by,
+            args.show_keywords, args.show_authors,
+            args.stats, args.init, args.interactive, args.import_files,
+            args.find_duplicates, args.find_near_duplicates,
+            args.compile_snapshot, args.backup,
+            args.export_changes is not None, args.apply_changes, args.maintain,
+            args.batch, args.compress_texts, args.decompress_texts)
     ):
         args.random = True
 
+    if len(args.file) > 1 and not any(
+        (args.list, args.random, args.count, args.count_by, args.show_keywords,
+         args.show_authors, args.stats)
+    ):
+        parser.error("this mode only accepts a single database file")
+    if args.new and len(args.file) > 1:
+        parser.error("--new only accepts a single database file")
+
     return args
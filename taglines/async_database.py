@@ -0,0 +1,102 @@
+""" Awaitable access to a tagline database for asyncio applications. """
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from taglines.database import Database, TaglineQuery
+
+
+class AsyncDatabase:  # {{{1
+    """ Asyncio facade around a Database.
+
+    All database work runs on one dedicated worker thread which owns the
+    sqlite connection, so the event loop never blocks on disk I/O. At most
+    max_pending requests may wait for that thread; further callers are
+    suspended until a slot becomes free. With bitmap_index, keyword, language
+    and author filters are answered from in-memory bitmaps, see
+    Database.use_bitmap_index(). """
+
+    def __init__(self, dbfilename, max_pending=32, bitmap_index=False):  # {{{2
+        self.database = Database(dbfilename)
+        self.database.use_bitmap_index(bitmap_index)
+        self.filters = {}
+        self.exact_author = False
+        self.keywords_or = False
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="taglines-db")
+        self._slots = asyncio.Semaphore(max_pending)
+
+    async def __aenter__(self):  # {{{2
+        return self
+
+    async def __aexit__(self, *exc_info):  # {{{2
+        await self.close()
+
+    async def parse_arguments(self, args):  # {{{2
+        """ Evaluate given arguments, see Database.parse_arguments().
+
+        This runs on the worker thread as well, since --new reads the
+        watermark from the database. """
+
+        query = await self._run(
+            TaglineQuery.from_arguments, self.database, args)
+        self.filters = query.filters
+        self.exact_author = query.exact_author
+        self.keywords_or = query.keywords_or
+
+    def _call(self, filter_state, function, args):  # {{{2
+        """ Run the given Database method on the worker thread.
+
+        The filter state is handed over with each call, so that changing the
+        filters in the event loop does not affect requests already queued. """
+
+        (self.database.filters, self.database.exact_author,
+            self.database.keywords_or) = filter_state
+        return function(*args)
+
+    async def _run(self, function, *args):  # {{{2
+        """ Queue a call for the worker thread and wait for its result. """
+
+        filter_state = (
+            dict(self.filters), self.exact_author, self.keywords_or)
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._call, filter_state, function, args)
+
+    async def taglines(self, random=False):  # {{{2
+        """ Return a list of all rows matching the set filters. """
+
+        def fetch(random):
+            cursor = self.database.taglines(random)
+            return cursor.fetchall() if cursor else []
+
+        return await self._run(fetch, random)
+
+    async def random_tagline(self):  # {{{2
+        """ Return a random tagline text matching the set filters. """
+
+        return await self._run(self.database.random_tagline)
+
+    async def stats(self):  # {{{2
+        """ Return the statistics dict, see Database.stats(). """
+
+        return await self._run(self.database.stats)
+
+    async def keywords(self, by_name=True):  # {{{2
+        """ Return a list of all keywords. """
+
+        return await self._run(
+            lambda by_name: list(self.database.keywords(by_name)), by_name)
+
+    async def authors(self, by_name=True):  # {{{2
+        """ Return a list of all authors. """
+
+        return await self._run(
+            lambda by_name: list(self.database.authors(by_name)), by_name)
+
+    async def close(self):  # {{{2
+        """ Close the connection on the worker thread and stop the thread. """
+
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.database.close)
+        self._executor.shutdown()
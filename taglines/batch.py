@@ -0,0 +1,208 @@
+""" Non-interactive changes of a database from a script of operations.
+
+A script is newline-delimited JSON with one operation per line, e.g.
+    {"op": "add", "texts": {"en": "..."}, "author": "Goethe",
+     "keywords": ["poetry"]}
+    {"op": "edit", "id": 12, "texts": {"de": "...", "en": null},
+     "source": "Faust"}
+    {"op": "delete", "id": 13}
+    {"op": "set_author", "id": 12, "author": "Goethe"}
+    {"op": "set_keywords", "id": 12, "keywords": ["poetry", "german"]}
+
+"add" and "edit" also accept "source", "remark" and "date" (YYYY-MM-DD). A
+text of null removes that language, an author of null removes the author.
+Authors and keywords are given by name and created if they do not exist yet.
+Operations are shown wrapped here, but each must be on a single line. Empty
+lines and lines starting with # are ignored. """
+
+import json
+import sqlite3
+import time
+from datetime import date
+from sys import stderr
+
+from taglines.database import DatabaseTagline, normalise_text, search_text
+
+
+class BatchError(Exception):  # {{{1
+    """ Exception that is raised for an invalid operation. """
+
+
+class Batch:  # {{{1
+    """ Apply a script of operations to a database in one transaction.
+
+    Every operation runs within its own savepoint, so a failing operation is
+    reported and undone without affecting the others. Texts that already
+    exist in another tagline are written anyway, but reported as warnings. """
+
+    def __init__(self, db):  # {{{2
+        self.db = db
+        self.applied = 0
+        self.errors = []
+        self.warnings = []
+        self._pending_warnings = []
+        self.created = {"authors": 0, "keywords": 0}
+        self._operations = {
+            "add": self._add,
+            "edit": self._edit,
+            "delete": self._delete,
+            "set_author": self._set_author,
+            "set_keywords": self._set_keywords,
+        }
+
+    def _name_id(self, table, column, name):  # {{{2
+        """ Return the ID of the author or keyword with the given name,
+        creating it if needed. """
+
+        if not isinstance(name, str) or not name.strip():
+            raise BatchError(f"Invalid name in {table}: {name!r}")
+        row = self.db.get_one(
+            f"SELECT id FROM {table} WHERE {column}=?", (name,))
+        if row:
+            return row[0]
+        self.created[table] += 1
+        return self.db.execute(
+            f"INSERT INTO {table} ({column}, search) VALUES (?,?)",
+            (name, search_text(name))).lastrowid
+
+    def _tagline(self, item):  # {{{2
+        """ Return the existing DatabaseTagline of the operation's id. """
+
+        tagline_id = item.get("id")
+        if not isinstance(tagline_id, int):
+            raise BatchError(
+                "The operation needs the integer id of a tagline.")
+        if not self.db.get_one(
+                "SELECT id FROM taglines WHERE id=?", (tagline_id,)):
+            raise BatchError(f"Tagline {tagline_id} does not exist.")
+        return DatabaseTagline(self.db, tagline_id)
+
+    def _apply_fields(self, tagline, item):  # {{{2
+        """ Set the texts, information, author and keywords given in an add
+        or edit. """
+
+        texts = item.get("texts", {})
+        if not isinstance(texts, dict):
+            raise BatchError("texts must be an object of language: text.")
+        for language, text in texts.items():
+            if text is None:
+                tagline.pop_text(language)
+            elif not isinstance(text, str) or not normalise_text(text):
+                raise BatchError(f"Invalid text for language {language}.")
+            else:
+                text = normalise_text(text)
+                others = [other for other in self.db.find_text(text)
+                          if other != tagline.id]
+                if others:
+                    self._pending_warnings.append(
+                        f"The {language} text already exists in tagline "
+                        f"{', '.join(str(other) for other in others)}.")
+                tagline.set_text(language, text)
+
+        if any(field in item for field in ("source", "remark", "date")):
+            when = item.get("date", tagline.when)
+            if isinstance(when, str):
+                try:
+                    when = date.fromisoformat(when)
+                except ValueError as error:
+                    raise BatchError(f"Invalid date: {when}") from error
+            tagline.set_information(
+                item.get("source", tagline.source),
+                item.get("remark", tagline.remark), when)
+        if "author" in item:
+            self._set_author(item, tagline)
+        if "keywords" in item:
+            self._set_keywords(item, tagline)
+
+    def _add(self, item):  # {{{2
+        if not item.get("texts"):
+            raise BatchError("A new tagline needs at least one text.")
+        tagline = DatabaseTagline(self.db)
+        self._apply_fields(tagline, item)
+        tagline.write()
+
+    def _edit(self, item):  # {{{2
+        tagline = self._tagline(item)
+        self._apply_fields(tagline, item)
+        if not tagline.texts:
+            raise BatchError(
+                "A tagline cannot be left without texts; delete it instead.")
+        tagline.write()
+
+    def _delete(self, item):  # {{{2
+        self._tagline(item).delete()
+
+    def _set_author(self, item, tagline=None):  # {{{2
+        if "author" not in item:
+            raise BatchError("The operation needs an author.")
+        write = tagline is None
+        tagline = tagline or self._tagline(item)
+        author = item["author"]
+        tagline.author = (None if author is None
+                          else self._name_id("authors", "name", author))
+        if write:
+            tagline.write()
+
+    def _set_keywords(self, item, tagline=None):  # {{{2
+        keywords = item.get("keywords")
+        if not isinstance(keywords, list):
+            raise BatchError("The operation needs a list of keywords.")
+        write = tagline is None
+        tagline = tagline or self._tagline(item)
+        tagline.set_keywords(
+            {self._name_id("keywords", "text", name) for name in keywords})
+        if write:
+            tagline.write()
+
+    def run(self, handle, progress=True):  # {{{2
+        """ Apply all operations read from the file handle and commit them.
+
+        Returns the number of successful operations; the failed ones are
+        listed in errors and the duplicate texts of successful ones in
+        warnings, both as tuples of line number and message. """
+
+        start = time.monotonic()
+        self.db.execute("BEGIN")
+        try:
+            for number, line in enumerate(handle, 1):
+                if not line.strip() or line.lstrip().startswith("#"):
+                    continue
+                self.db.execute("SAVEPOINT operation")
+                created = dict(self.created)
+                self._pending_warnings = []
+                try:
+                    item = json.loads(line)
+                    if not isinstance(item, dict):
+                        raise BatchError("An operation must be an object.")
+                    name = item.get("op")
+                    if not isinstance(name, str) or \
+                            name not in self._operations:
+                        raise BatchError(f"Unknown operation: {name!r}")
+                    self._operations[name](item)
+                except (BatchError, ValueError, sqlite3.Error) as error:
+                    self.db.execute("ROLLBACK TO operation")
+                    self.created = created
+                    self.errors.append((number, str(error)))
+                    if progress:
+                        print(f"Line {number}: {error}", file=stderr)
+                else:
+                    self.applied += 1
+                    for warning in self._pending_warnings:
+                        self.warnings.append((number, warning))
+                        if progress:
+                            print(f"Line {number}: {warning}", file=stderr)
+                self.db.execute("RELEASE operation")
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+        if progress:
+            elapsed = time.monotonic() - start
+            print(f"Applied {self.applied} operations in {elapsed:.2f}s "
+                  f"({self.applied / elapsed if elapsed else 0:.0f}/s), "
+                  f"{len(self.errors)} failed, {len(self.warnings)} "
+                  f"duplicate texts; created "
+                  f"{self.created['authors']} authors and "
+                  f"{self.created['keywords']} keywords.", file=stderr)
+        return self.applied
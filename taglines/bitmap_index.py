@@ -0,0 +1,334 @@
+""" In-memory bitmap index over the lines of a database.
+
+Every line gets a dense ordinal, and every keyword, language and author a
+bitmap with one bit per ordinal, stored as a Python int. Keywords and authors
+belong to taglines, so their bits are set for all lines of a tagline. Filters
+then become bitwise AND, OR and NOT over whole bitmaps, which takes
+microseconds instead of a grouped query over kw_tl.
+
+The index is built on first use and afterwards kept up to date from the change
+log: only the taglines whose rows changed since are read again. """
+
+import re
+import threading
+from array import array
+
+from taglines import keyword_expression
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# rebuild from scratch instead of updating if more changes accumulated
+_MAX_INCREMENTAL_CHANGES = 10000
+
+
+def _ordinals(bitmap):  # {{{1
+    """ Return the positions of the set bits of a bitmap, ascending. """
+
+    if not bitmap:
+        return []
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    if numpy is not None:
+        bits = numpy.unpackbits(
+            numpy.frombuffer(data, dtype=numpy.uint8), bitorder="little")
+        return numpy.flatnonzero(bits).tolist()
+    positions = []
+    for index, byte in enumerate(data):
+        while byte:
+            lowest = byte & -byte
+            positions.append(index * 8 + lowest.bit_length() - 1)
+            byte ^= lowest
+    return positions
+
+
+def _like(pattern):  # {{{1
+    """ Return a regular expression matching like the SQL pattern %pattern%.
+
+    As in sqlite, % and _ are wildcards and only ASCII letters are compared
+    case-insensitively; the names are matched in their folded form like in
+    the SQL filter. """
+
+    parts = (".*" if char == "%" else "." if char == "_" else re.escape(char)
+             for char in pattern)
+    return re.compile(".*" + "".join(parts) + ".*",
+                      re.IGNORECASE | re.ASCII | re.DOTALL)
+
+
+class BitmapIndex:  # {{{1
+    """ Bitmaps of the lines per keyword, language and author of a schema. """
+
+    def __init__(self, db, schema="main"):  # {{{2
+        self.db = db
+        self.schema = schema
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):  # {{{2
+        """ Read all lines and their taglines' keywords and authors. """
+
+        schema = self.schema
+        self._last_change = self.db.get_one(
+            f"SELECT max(id) FROM {schema}.changes")[0] or 0
+        self.line_ids = array("l")
+        self._ordinal = {}
+        self._line_language = {}
+        self._line_tagline = {}
+        self._tagline_lines = {}
+        self._tagline_author = {}
+        self._tagline_keywords = {}
+        self._assignments = {}
+        self.all = 0
+        self.languages = {}
+        self.authors = {}
+        self.keywords = {}
+
+        for row_id, keyword, tagline in self.db.execute(
+                f"SELECT id, keyword, tagline FROM {schema}.kw_tl"):
+            self._assignments[row_id] = tagline
+            self._tagline_keywords.setdefault(tagline, set()).add(keyword)
+        for tagline, author in self.db.execute(
+                f"SELECT id, author FROM {schema}.taglines "
+                "WHERE author IS NOT NULL"):
+            self._tagline_author[tagline] = author
+
+        languages = {}
+        authors = {}
+        keywords = {}
+        for line_id, tagline, language in self.db.execute(
+                f"SELECT id, tagline, language FROM {schema}.lines "
+                "ORDER BY id"):
+            ordinal = self._add_line(line_id, tagline, language)
+            languages.setdefault(language, []).append(ordinal)
+            if tagline in self._tagline_author:
+                authors.setdefault(
+                    self._tagline_author[tagline], []).append(ordinal)
+            for keyword in self._tagline_keywords.get(tagline, ()):
+                keywords.setdefault(keyword, []).append(ordinal)
+
+        # setting many bits at once is much cheaper than one int operation
+        # per bit
+        self.all = self._bitmap(range(len(self.line_ids)))
+        self.languages = {key: self._bitmap(ordinals)
+                          for key, ordinals in languages.items()}
+        self.authors = {key: self._bitmap(ordinals)
+                        for key, ordinals in authors.items()}
+        self.keywords = {key: self._bitmap(ordinals)
+                         for key, ordinals in keywords.items()}
+        self._load_names()
+        self._loaded = True
+
+    @staticmethod
+    def _bitmap(ordinals):  # {{{2
+        """ Return a bitmap with the bits of the given ordinals set. """
+
+        data = bytearray(((max(ordinals) >> 3) + 1) if ordinals else 0)
+        for ordinal in ordinals:
+            data[ordinal >> 3] |= 1 << (ordinal & 7)
+        return int.from_bytes(data, "little")
+
+    def _add_line(self, line_id, tagline, language):  # {{{2
+        """ Give a line the next ordinal and return it. """
+
+        ordinal = len(self.line_ids)
+        self.line_ids.append(line_id)
+        self._ordinal[line_id] = ordinal
+        self._line_language[ordinal] = language
+        self._line_tagline[ordinal] = tagline
+        self._tagline_lines.setdefault(tagline, []).append(ordinal)
+        return ordinal
+
+    def _load_names(self):  # {{{2
+        """ Read the names, with their folded form, of all authors and the
+        names of all keywords. """
+
+        self.author_names = {
+            author_id: (name, folded) for author_id, name, folded in
+            self.db.execute(
+                f"SELECT id, name, search FROM {self.schema}.authors")}
+        self.keyword_ids = {
+            text: keyword_id for keyword_id, text in self.db.execute(
+                f"SELECT id, text FROM {self.schema}.keywords")}
+
+    def refresh(self):  # {{{2
+        """ Load the index or apply the changes made since it was last
+        brought up to date. """
+
+        if not self._loaded:
+            self._load()
+            return
+        changes = self.db.execute(
+            f"SELECT id, tbl, row FROM {self.schema}.changes "
+            "WHERE id>? ORDER BY id LIMIT ?",
+            (self._last_change, _MAX_INCREMENTAL_CHANGES + 1)).fetchall()
+        if not changes:
+            return
+        # every update leaves unused ordinals behind, which make all bitmaps
+        # longer
+        limit = 2 * self.all.bit_count() + _MAX_INCREMENTAL_CHANGES
+        if len(changes) > _MAX_INCREMENTAL_CHANGES or \
+                len(self.line_ids) > limit:
+            self._load()
+            return
+        self._last_change = changes[-1][0]
+
+        taglines = set()
+        for _, table, row in changes:
+            if table == "taglines":
+                taglines.add(row)
+            elif table == "lines":
+                if row in self._ordinal:
+                    taglines.add(self._line_tagline[self._ordinal[row]])
+                found = self.db.get_one(
+                    f"SELECT tagline FROM {self.schema}.lines WHERE id=?",
+                    (row,))
+                if found:
+                    taglines.add(found[0])
+            elif table == "kw_tl":
+                if row in self._assignments:
+                    taglines.add(self._assignments[row])
+                found = self.db.get_one(
+                    f"SELECT tagline FROM {self.schema}.kw_tl WHERE id=?",
+                    (row,))
+                if found:
+                    taglines.add(found[0])
+        for tagline in taglines:
+            self._reindex(tagline)
+        if any(table in ("authors", "keywords") for _, table, _ in changes):
+            self._load_names()
+
+    def _reindex(self, tagline):  # {{{2
+        """ Read the lines, keywords and author of one tagline again. """
+
+        schema = self.schema
+        old = self._tagline_lines.pop(tagline, [])
+        if old:
+            mask = ~self._bitmap(old)
+            self.all &= mask
+            for ordinal in old:
+                language = self._line_language.pop(ordinal)
+                self.languages[language] &= mask
+                del self._line_tagline[ordinal]
+                del self._ordinal[self.line_ids[ordinal]]
+            author = self._tagline_author.get(tagline)
+            if author in self.authors:
+                self.authors[author] &= mask
+            for keyword in self._tagline_keywords.get(tagline, ()):
+                self.keywords[keyword] &= mask
+
+        # assignments are not moved between taglines, so the old entries of
+        # _assignments can stay; deleted rows are never looked up again
+        keywords = set()
+        for row_id, keyword in self.db.execute(
+                f"SELECT id, keyword FROM {schema}.kw_tl WHERE tagline=?",
+                (tagline,)):
+            self._assignments[row_id] = tagline
+            keywords.add(keyword)
+        self._tagline_keywords[tagline] = keywords
+        row = self.db.get_one(
+            f"SELECT author FROM {schema}.taglines WHERE id=?", (tagline,))
+        author = row[0] if row else None
+        self._tagline_author[tagline] = author
+
+        ordinals = []
+        for line_id, language in self.db.execute(
+                f"SELECT id, language FROM {schema}.lines "
+                "WHERE tagline=? ORDER BY id", (tagline,)):
+            ordinal = self._add_line(line_id, tagline, language)
+            ordinals.append(ordinal)
+            bit = 1 << ordinal
+            self.languages[language] = self.languages.get(language, 0) | bit
+        if ordinals:
+            bits = self._bitmap(ordinals)
+            self.all |= bits
+            if author is not None:
+                self.authors[author] = self.authors.get(author, 0) | bits
+            for keyword in keywords:
+                self.keywords[keyword] = self.keywords.get(keyword, 0) | bits
+
+    @staticmethod
+    def _languages(filters):  # {{{2
+        languages = filters.get("language") or []
+        if isinstance(languages, str):
+            languages = languages.split(",")
+        return [language.strip() for language in languages if language.strip()]
+
+    @staticmethod
+    def supports(filters):  # {{{2
+        """ Return whether the filters (of a TaglineQuery) can be evaluated
+        by the index. """
+
+        languages = BitmapIndex._languages(filters)
+        return (len(languages) <= 1 and "*" not in languages
+                and set(filters) <= {
+                    "author", "keywords", "keyword_expression", "language"})
+
+    def _keyword(self, name):  # {{{2
+        return self.keywords.get(self.keyword_ids.get(name), 0)
+
+    def _expression(self, tree):  # {{{2
+        """ Evaluate a tree of keyword_expression into a bitmap. """
+
+        kind = tree[0]
+        if kind == "keyword":
+            return self._keyword(tree[1])
+        if kind == "not":
+            return self.all & ~self._expression(tree[1])
+        bitmaps = [self._expression(node) for node in tree[1]]
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            result = result & bitmap if kind == "and" else result | bitmap
+        return result
+
+    def select(self, filters, exact_author=False, keywords_or=False):  # {{{2
+        """ Return the bitmap of the lines matching filters supported by the
+        index. """
+
+        with self._lock:
+            self.refresh()
+            return self._select(filters, exact_author, keywords_or)
+
+    def _select(self, filters, exact_author, keywords_or):  # {{{2
+        result = self.all
+
+        author = filters.get("author")
+        if author:
+            # imported here, as the database module imports this one
+            from taglines.database import search_text
+
+            matches = 0
+            pattern = None if exact_author else _like(search_text(author))
+            for author_id, (name, folded) in self.author_names.items():
+                if name is None:
+                    continue
+                if name == author if exact_author else \
+                        pattern.fullmatch(folded or ""):
+                    matches |= self.authors.get(author_id, 0)
+            result &= matches
+
+        keywords = filters.get("keywords")
+        if keywords:
+            if keywords_or:
+                matches = 0
+                for name in keywords:
+                    matches |= self._keyword(name)
+            else:
+                matches = self.all
+                for name in keywords:
+                    matches &= self._keyword(name)
+            result &= matches
+
+        expression = filters.get("keyword_expression")
+        if expression:
+            result &= self._expression(keyword_expression.parse(expression))
+
+        for language in self._languages(filters):
+            result &= self.languages.get(language, 0)
+        return result
+
+    def line_ids_of(self, bitmap):  # {{{2
+        """ Return the line IDs of a bitmap in ascending order of ordinals. """
+
+        return array("l", (self.line_ids[ordinal]
+                           for ordinal in _ordinals(bitmap)))
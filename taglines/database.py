@@ -1,13 +1,276 @@
 """ Encapsulation of tagline data in an sqlite database file. """
 
+import gzip
+import hashlib
+import heapq
+import json
 import os
 import sqlite3
 import shutil
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
 from datetime import date
+from random import sample
 from sys import stderr
 from pathlib import Path
 
-__db_version__ = 1
+from taglines import keyword_expression
+from taglines.bitmap_index import BitmapIndex
+from taglines.text_compression import TextCodec, dictionary_id
+
+__db_version__ = 11
+
+# rows of the status table
+_STATUS_VERSION = 0
+_STATUS_UPGRADE_PROGRESS = 1
+# the ID of the newest line seen by the last run with --new
+_STATUS_WATERMARK = 2
+# the codec and dictionary with which texts are compressed, if they are
+_STATUS_TEXT_CODEC = 3
+_STATUS_TEXT_DICTIONARY = 4
+# plus the version number: seconds spent on the upgrade to that version
+_STATUS_UPGRADE_TIME = 100
+
+# statements which never need the writer lock
+_READ_STATEMENTS = ("select", "pragma", "explain", "with")
+# number of filter sets whose matching line IDs are kept in memory
+_CACHE_SIZE = 32
+# filters for the size of a text, and the column of lines they limit
+_SIZE_FILTERS = {"max_lines": "line_count", "max_width": "width", "max_chars": "length"}
+# filters for dates in ISO format, and their condition
+_DATE_FILTERS = {
+    "added_since": "l.date>=?", "added_until": "l.date<=?",
+    "dated_since": "tl.date>=?", "dated_until": "tl.date<=?",
+}
+
+
+def normalise_text(text):  # {{{1
+    """ Unify line ends and strip trailing whitespace and empty edge lines. """
+
+    lines = unicodedata.normalize("NFC", text.replace("\r\n", "\n")).split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+
+def content_hash(text):  # {{{1
+    """ Return a hash of the text that ignores case and whitespace layout. """
+
+    canonical = " ".join(unicodedata.normalize("NFC", text).split()).casefold()
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def search_text(text):  # {{{1
+    """ Return the text case-folded and without diacritics, for searching. """
+
+    return "".join(char for char in unicodedata.normalize("NFKD", text.casefold())
+                   if not unicodedata.combining(char))
+
+
+def text_size(text):  # {{{1
+    """ Return the number of lines, the width of the widest line and the length of a text.
+
+    Wide characters, e.g. of Chinese, count as two columns. """
+
+    lines = text.split("\n")
+    width = max(sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in line)
+                for line in lines)
+    return (len(lines), width, len(text))
+
+
+# columns of lines which are computed from its text
+DERIVED_COLUMNS = ("hash", "search", "line_count", "width", "length")
+
+
+def derived_values(text):  # {{{1
+    """ Return the values of the DERIVED_COLUMNS for a text. """
+
+    return (content_hash(text), search_text(text)) + text_size(text)
+
+
+class Backfill:  # {{{1
+    """ Migration step that computes new column values for all rows of a table.
+
+    The rows are processed in chunks of ascending ID, each in its own
+    transaction, so that an interrupted upgrade can continue where it stopped
+    and readers are only blocked for the duration of one chunk. """
+
+    def __init__(self, table, columns, sources, function):  # {{{2
+        """ @param columns: names of the columns to set
+            @param sources: names of the columns passed to function
+            @param function: returns a tuple of values for columns """
+
+        self.table = table
+        self.columns = columns
+        self.sources = sources
+        self.function = function
+
+    def select(self):  # {{{2
+        """ Return the query for the next chunk of rows after a given ID. """
+
+        sources = ", ".join(f"unpack_text({source})" for source in self.sources)
+        return (f"SELECT id, {sources} FROM {self.table} "
+                "WHERE id>? ORDER BY id LIMIT ?")
+
+    def update(self):  # {{{2
+        """ Return the query which stores the computed values of one row. """
+
+        return (f"UPDATE {self.table} SET {', '.join(c + '=?' for c in self.columns)} "
+                "WHERE id=?")
+
+
+# the tables with a trigram index over the folded copy of one of their
+# columns, kept in their search column like for lines, and its name
+NAME_INDEXES = {
+    "authors": ("name", "author_names"),
+    "keywords": ("text", "keyword_names"),
+}
+
+
+def trigram_available():  # {{{1
+    """ Return whether sqlite supports FTS5 with the trigram tokenizer. """
+
+    if not hasattr(trigram_available, "result"):
+        try:
+            sqlite3.connect(":memory:").execute(
+                "CREATE VIRTUAL TABLE test USING fts5(text, tokenize='trigram')")
+            trigram_available.result = True
+        except sqlite3.OperationalError:
+            trigram_available.result = False
+    return trigram_available.result
+
+
+def trigrams(text):  # {{{1
+    """ Return the set of character trigrams of the folded text. """
+
+    text = f"  {search_text(text or '')} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _create_name_indexes(db):  # {{{1
+    """ Create the trigram indexes over the folded author names and keywords.
+
+    They are external content FTS5 tables, kept in sync by triggers. Without
+    trigram support nothing is created and lookups fall back to scanning. """
+
+    if not trigram_available():
+        return
+    for table, (_, index) in NAME_INDEXES.items():
+        db.execute(f"CREATE VIRTUAL TABLE {index} USING fts5(search, content='{table}', content_rowid='id', tokenize='trigram')")
+        db.execute(f"""CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {index} (rowid, search) VALUES (NEW.id, NEW.search); END""")
+        db.execute(f"""CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {index} ({index}, rowid, search) VALUES ('delete', OLD.id, OLD.search); END""")
+        db.execute(f"""CREATE TRIGGER {index}_update AFTER UPDATE OF id, search ON {table} BEGIN
+            INSERT INTO {index} ({index}, rowid, search) VALUES ('delete', OLD.id, OLD.search);
+            INSERT INTO {index} (rowid, search) VALUES (NEW.id, NEW.search); END""")
+        db.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+
+
+def _create_search_index(db):  # {{{1
+    """ Create the trigram index over the normalised text of all lines. """
+
+    if not trigram_available():
+        return
+    db.execute("CREATE VIRTUAL TABLE lines_search USING fts5(search, content='lines', content_rowid='id', tokenize='trigram')")
+    db.execute("""CREATE TRIGGER lines_search_insert AFTER INSERT ON lines BEGIN
+        INSERT INTO lines_search (rowid, search) VALUES (NEW.id, NEW.search); END""")
+    db.execute("""CREATE TRIGGER lines_search_delete AFTER DELETE ON lines BEGIN
+        INSERT INTO lines_search (lines_search, rowid, search) VALUES ('delete', OLD.id, OLD.search); END""")
+    db.execute("""CREATE TRIGGER lines_search_update AFTER UPDATE OF id, search ON lines BEGIN
+        INSERT INTO lines_search (lines_search, rowid, search) VALUES ('delete', OLD.id, OLD.search);
+        INSERT INTO lines_search (rowid, search) VALUES (NEW.id, NEW.search); END""")
+    db.execute("INSERT INTO lines_search (lines_search) VALUES ('rebuild')")
+
+
+# the tables whose changes are recorded in the change log, with the columns
+# edited by the user (columns derived from them are not logged separately)
+LOGGED_TABLES = {
+    "authors": ("name", "born", "died"),
+    "keywords": ("text",),
+    "taglines": ("author", "source", "remark", "date"),
+    "lines": ("tagline", "date", "language", "text"),
+    "kw_tl": ("keyword", "tagline"),
+}
+
+
+def _change_log_triggers():  # {{{1
+    """ Return the statements creating the triggers that feed the change log. """
+
+    statements = []
+    for table, columns in LOGGED_TABLES.items():
+        statements += [
+            f"""CREATE TRIGGER {table}_log_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO changes (tbl, row, op) VALUES ('{table}', NEW.id, 'i'); END""",
+            f"""CREATE TRIGGER {table}_log_update AFTER UPDATE OF id, {", ".join(columns)} ON {table} BEGIN
+            INSERT INTO changes (tbl, row, op) SELECT '{table}', OLD.id, 'd' WHERE OLD.id != NEW.id;
+            INSERT INTO changes (tbl, row, op) VALUES ('{table}', NEW.id, 'u'); END""",
+            f"""CREATE TRIGGER {table}_log_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO changes (tbl, row, op) VALUES ('{table}', OLD.id, 'd'); END""",
+        ]
+    return statements
+
+
+# The steps to upgrade the schema from the previous version to the key's.
+# A step is an SQL statement, a Backfill or a function called with the
+# Database, and each step is committed on its own together with the upgrade
+# progress.
+MIGRATIONS = {
+    1: [
+        'ALTER TABLE tags RENAME TO keywords',
+        'CREATE TABLE kw_tl (id INTEGER PRIMARY KEY, keyword INT, tagline INT)',
+        'INSERT INTO kw_tl SELECT * FROM tag',
+        'DROP TABLE tag',
+    ],
+    2: [
+        'ALTER TABLE lines ADD COLUMN hash TEXT',
+        Backfill('lines', ('hash',), ('text',), lambda text: (content_hash(text or ""),)),
+        'CREATE INDEX lines_hash ON lines (hash, tagline)',
+    ],
+    3: [
+        # MinHash signatures for near-duplicate detection, with the hash of the text they were computed from
+        'CREATE TABLE signatures (line INTEGER PRIMARY KEY, hash TEXT, minhash BLOB)',
+    ],
+    4: [
+        # every insert, update and delete of the LOGGED_TABLES, for replication
+        'CREATE TABLE changes (id INTEGER PRIMARY KEY, tbl TEXT, row INT, op TEXT)',
+    ] + _change_log_triggers(),
+    5: [
+        'CREATE INDEX lines_tagline ON lines (tagline, language)',
+    ],
+    6: [
+        'ALTER TABLE authors ADD COLUMN search TEXT',
+        Backfill('authors', ('search',), ('name',), lambda name: (search_text(name or ""),)),
+        'ALTER TABLE keywords ADD COLUMN search TEXT',
+        Backfill('keywords', ('search',), ('text',), lambda text: (search_text(text or ""),)),
+        _create_name_indexes,
+    ],
+    7: [
+        'ALTER TABLE lines ADD COLUMN search TEXT',
+        Backfill('lines', ('search',), ('text',), lambda text: (search_text(text or ""),)),
+        _create_search_index,
+    ],
+    8: [
+        # keyword expressions look up the taglines of each keyword
+        'CREATE INDEX kw_tl_keyword ON kw_tl (keyword, tagline)',
+    ],
+    9: [
+        'ALTER TABLE lines ADD COLUMN line_count INT',
+        'ALTER TABLE lines ADD COLUMN width INT',
+        'ALTER TABLE lines ADD COLUMN length INT',
+        Backfill('lines', ('line_count', 'width', 'length'), ('text',),
+                 lambda text: text_size(text or "")),
+        'CREATE INDEX lines_size ON lines (line_count, width, length)',
+    ],
+    10: [
+        'CREATE INDEX lines_date ON lines (date)',
+        'CREATE INDEX taglines_date ON taglines (date)',
+    ],
+    # no change of the schema, but texts may from now on be stored compressed,
+    # which older programs would read as garbage
+    11: [],
+}
 
 
 class Database:  # {{{1
@@ -20,10 +283,36 @@ class Database:  # {{{1
             super(Database.DatabaseError, self).__init__()
             self.args = (message,)
 
-    def __init__(self, dbfilename=None):  # {{{2
+    def __init__(self, dbfilename=None, in_memory=False):  # {{{2
         self.is_open = False
-        self.db = None
         self.filename = None
+        # work on a copy in memory, which is written back to the file on
+        # commit() and close(); _file is the connection to the file itself.
+        # The copy may only be used by the thread which opened it
+        self.in_memory = in_memory
+        self._file = None
+        self._file_version = None
+        self._written_changes = 0
+        # every thread gets its own connection; only one of them may have an
+        # open write transaction at a time, guarded by the writer lock
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._writer_lock = threading.Lock()
+        # matching line IDs per filter set, valid while _changes is unchanged
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_stamp = None
+        # compiled SQL per filter set and schema
+        self._compiled = OrderedDict()
+        # a BitmapIndex per schema once enabled with use_bitmap_index()
+        self._bitmap_indexes = None
+        # the TextCodec of new texts, and all TextCodecs of all schemas by ID
+        self._text_codec = None
+        self._text_codecs = {}
+        self._changes = 0
+        # further database files whose content is queried together with ours
+        self.attached = []
         self.filters = {}
         self.exact_author = False
         self.keywords_or = False
@@ -34,6 +323,81 @@ class Database:  # {{{1
     def __del__(self):  # {{{2
         self.close()
 
+    @property
+    def db(self):  # {{{2
+        """ The sqlite connection of the calling thread.
+
+        It is created on first use, provided the database has been opened. """
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None and self.is_open:
+            connection = self._connect()
+        return connection
+
+    def _connect(self):  # {{{2
+        """ Create a new connection for the calling thread. """
+
+        # connections are only ever used by the thread that created them, but
+        # close() must be able to close all of them from any thread
+        if self.in_memory:
+            # connections to a shared cache in memory lock each other out
+            # table by table without waiting, and a single shared connection
+            # starves the write-back, so there is only one thread
+            if self._connections:
+                raise Database.DatabaseError(
+                    "A database loaded into memory can only be used by one thread.")
+            connection = sqlite3.connect(
+                ":memory:", detect_types=True, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(
+                self.filename, detect_types=True, check_same_thread=False)
+        connection.create_function("unpack_text", 1, self.unpack_text, deterministic=True)
+        for schema, path in zip(self.schemas[1:], self.attached):
+            connection.execute("ATTACH DATABASE ? AS ?", (path, schema))
+        self._local.connection = connection
+        with self._connections_lock:
+            self._connections.append(connection)
+        return connection
+
+    def _acquire_writer(self):  # {{{2
+        """ Make the calling thread the database's only writer. """
+
+        if not getattr(self._local, "writing", False):
+            self._writer_lock.acquire()
+            self._local.writing = True
+
+    def _release_writer(self):  # {{{2
+        """ Allow other threads to write after a commit. """
+
+        if getattr(self._local, "writing", False):
+            self._local.writing = False
+            self._writer_lock.release()
+
+    @property
+    def schemas(self):  # {{{2
+        """ The names of all databases in a query, starting with the main one. """
+
+        return ["main"] + [f"db{number}" for number in range(1, len(self.attached) + 1)]
+
+    def attach(self, path):  # {{{2
+        """ Add another database file whose content is included in queries.
+
+        The file is upgraded to the current schema first if necessary. All
+        writes still go to the main database. """
+
+        other = Database(path)
+        other.open()
+        other.close()
+        self.attached.append(other.filename)
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.execute("ATTACH DATABASE ? AS ?", (other.filename, self.schemas[-1]))
+        with self._cache_lock:
+            self._cache.clear()
+            self._compiled.clear()
+        if self.is_open:
+            self._load_text_codecs()
+
     def set_path(self, path):  # {{{2
         """ Set the instance's database filename.
 
@@ -54,13 +418,58 @@ class Database:  # {{{1
 
         if self.is_open:
             return True
-        self.db = sqlite3.connect(self.filename, detect_types=True)
-        self.is_open = isinstance(self.db, sqlite3.Connection)
+        if self.in_memory:
+            return self._load()
+        self.is_open = isinstance(self._connect(), sqlite3.Connection)
 
         if not self.version_is_current():
             self.upgrade_version()
+        self._load_text_codecs()
         return self.is_open
 
+    def _load(self):  # {{{2
+        """ Open the database by copying the file into memory.
+
+        The file is upgraded to the current schema first if necessary. """
+
+        other = Database(self.filename)
+        other.open()
+        other.close()
+
+        self._file = sqlite3.connect(self.filename, check_same_thread=False)
+        try:
+            self._file.backup(self._connect())
+        except sqlite3.Error as error:
+            self._file.close()
+            self._file = None
+            raise Database.DatabaseError(f"An sqlite3 error occurred: {error.args[0]}")
+        self._file_version = self._file.execute("PRAGMA data_version").fetchone()[0]
+        self._written_changes = self._changes
+        self.is_open = True
+        self._load_text_codecs()
+        return True
+
+    def write_back(self):  # {{{2
+        """ Replace the file's content with the copy in memory.
+
+        This only happens if there were changes since the last write-back.
+        The copy is written in one transaction, so the file never contains
+        half of it. If another program has modified the file since it was
+        loaded, nothing is written and a DatabaseError is raised. """
+
+        if not self.in_memory or not self.is_open or self._changes == self._written_changes:
+            return
+        if self._file.execute("PRAGMA data_version").fetchone()[0] != self._file_version:
+            raise Database.DatabaseError(
+                f"{self.filename} has been modified by another program since it "
+                "was loaded into memory; the changes were not written back.")
+        try:
+            self.db.backup(self._file)
+        except sqlite3.Error as error:
+            raise Database.DatabaseError(f"An sqlite3 error occurred: {error.args[0]}")
+        # writes through the connection itself do not change its data_version
+        self._written_changes = self._changes
+
     def initialise_file(self, filename):  # {{{2
         """ Initialise a new, empty database """
         # pylint: disable=line-too-long
@@ -71,8 +480,9 @@ class Database:  # {{{1
         try:
             Path.touch(filename)
             self.filename = filename
-            self.db = sqlite3.connect(self.filename)
-            cursor = self.db.cursor()
+            cursor = self._connect().cursor()
+            self._acquire_writer()
+            # the schema of version 1; everything later is added by the migrations
             cursor.execute('CREATE TABLE authors (id INTEGER PRIMARY KEY, name TEXT, born INT DEFAULT NULL, died INT DEFAULT NULL)')
             cursor.execute('CREATE TABLE lines (id INTEGER PRIMARY KEY, tagline INT, date DATE, language VARCHAR(5), text TEXT)')
             # the keyword-tagline assignment table
@@ -81,9 +491,10 @@ class Database:  # {{{1
             cursor.execute('CREATE TABLE keywords (id INTEGER PRIMARY KEY, text TEXT UNIQUE)')
             cursor.execute('CREATE TABLE status (id INTEGER PRIMARY KEY, value TEXT)')
             # database version for later recognition (and conversion)
-            cursor.execute('INSERT INTO status VALUES (0, ?)', (str(__db_version__),))
-            self.db.commit()
+            cursor.execute('INSERT INTO status VALUES (?, ?)', (_STATUS_VERSION, "1"))
             self.is_open = True
+            self.commit()
+            self.migrate(1, quiet=True)
         except IOError as error:
             raise Database.DatabaseError(f"Error creating database file: {error.args[0]}")
         except sqlite3.Error as error:
@@ -116,20 +527,21 @@ class Database:  # {{{1
         """ Do an automatic schema upgrade of the database. """
 
         try:
-            row = self.get_one("SELECT value FROM status WHERE id=0")
+            row = self.get_one("SELECT value FROM status WHERE id=?", (_STATUS_VERSION,))
         # no status table (indicative of a first-version database)
         except sqlite3.OperationalError:
             self.execute('CREATE TABLE status (id INTEGER PRIMARY KEY, value TEXT);')
             row = None
 
         if row is None:
-            self.execute('INSERT INTO status VALUES (0, 0)')
+            self.execute('INSERT INTO status VALUES (?, 0)', (_STATUS_VERSION,))
             dbversion = 0
         else:
             try:
                 dbversion = int(row[0])
             except TypeError:
                 dbversion = 0
+        self.commit()
 
         if dbversion > __db_version__:
             raise Exception(
@@ -138,36 +550,157 @@ class Database:  # {{{1
         if dbversion < __db_version__:
             print("Database version is out of date. Need to upgrade first.",
                   file=stderr)
-            print("Creating backup of database (appending .upgradebackup)",
-                  file=stderr)
-            shutil.copy(self.filename, self.filename + ".upgradebackup")
-        while dbversion < __db_version__:
-            dbversion += 1
-            print(f"Upgrading to version {dbversion}...", file=stderr)
+            # an interrupted upgrade already made its backup
+            if self.get_one("SELECT value FROM status WHERE id=?", (_STATUS_UPGRADE_PROGRESS,)):
+                print("Resuming interrupted upgrade.", file=stderr)
+            else:
+                print("Creating backup of database (appending .upgradebackup)",
+                      file=stderr)
+                self.backup(self.filename + ".upgradebackup")
+            self.migrate(dbversion)
+            print("Upgrade complete.", file=stderr)
+
+    def migrate(self, dbversion, quiet=False, chunk_size=5000):  # {{{2
+        """ Run all migrations after the given schema version.
+
+        Each step runs in its own transaction, which also records how far the
+        upgrade has come. If the upgrade is interrupted, the next call skips
+        everything that has already been done. The record is only removed
+        together with the last version, as it also tells upgrade_version()
+        that the backup of the original file has already been made. """
+
+        def report(text, end="\n"):
+            if not quiet:
+                print(text, end=end, file=stderr)
+
+        def set_status(key, value):
+            self.execute("INSERT OR REPLACE INTO status (id, value) VALUES (?, ?)", (key, value))
+
+        row = self.get_one("SELECT value FROM status WHERE id=?", (_STATUS_UPGRADE_PROGRESS,))
+        # version, step and last processed row ID of the interrupted upgrade
+        resume = tuple(int(value) for value in row[0].split()) if row else (0, 0, 0)
+
+        for version in range(dbversion + 1, __db_version__ + 1):
+            report(f"Upgrading to version {version}...")
+            start = time.monotonic()
+            for step, migration in enumerate(MIGRATIONS[version]):
+                if (version, step) < resume[:2]:
+                    continue
+
+                if not isinstance(migration, Backfill):
+                    self.execute("BEGIN")
+                    if callable(migration):
+                        migration(self)
+                    else:
+                        self.execute(migration)
+                    set_status(_STATUS_UPGRADE_PROGRESS, f"{version} {step + 1} 0")
+                    self.commit()
+                    continue
+
+                last_id = resume[2] if (version, step) == resume[:2] else 0
+                total = self.get_one(
+                    f"SELECT count(*) FROM {migration.table} WHERE id>?", (last_id,))[0]
+                done = 0
+                while True:
+                    self.execute("BEGIN")
+                    rows = self.execute(migration.select(), (last_id, chunk_size)).fetchall()
+                    if not rows:
+                        self.commit()
+                        break
+                    self.db.executemany(migration.update(), (
+                        migration.function(*row[1:]) + (row[0],) for row in rows))
+                    last_id = rows[-1][0]
+                    done += len(rows)
+                    set_status(_STATUS_UPGRADE_PROGRESS, f"{version} {step} {last_id}")
+                    self.commit()
+                    report(f"\r  {migration.table}: {done}/{total} rows", end="")
+                if total:
+                    report("")
+                set_status(_STATUS_UPGRADE_PROGRESS, f"{version} {step + 1} 0")
+                self.commit()
+
+            self.execute("BEGIN")
+            set_status(_STATUS_UPGRADE_TIME + version, f"{time.monotonic() - start:.3f}")
+            set_status(_STATUS_VERSION, str(version))
+            if version == __db_version__:
+                self.execute("DELETE FROM status WHERE id=?", (_STATUS_UPGRADE_PROGRESS,))
+            else:
+                set_status(_STATUS_UPGRADE_PROGRESS, f"{version + 1} 0 0")
+            self.commit()
+
+    def backup(self, destination, compress=False, verify=False, pages=1024):  # {{{2
+        """ Write a consistent copy of the database to the destination file.
+
+        The copy is made with sqlite's online backup API in steps of the
+        given number of pages, so other connections may keep reading (and
+        writing, which restarts the copy) in between. Optionally the copy is
+        checked with PRAGMA integrity_check and compressed with gzip. """
 
-            if dbversion == 1:
-                self.execute('ALTER TABLE tags RENAME TO keywords')
-                self.execute('CREATE TABLE kw_tl (id INTEGER PRIMARY KEY, keyword INT, tagline INT)')
-                self.execute('INSERT INTO kw_tl SELECT * FROM tag')
-                self.execute('DROP TABLE tag')
-                self.execute('UPDATE status SET value=? WHERE id=0', str(__db_version__))
+        if not self.is_open and not self.open():
+            return False
+
+        def progress(_status, remaining, total):
+            print(f"\rBackup: {total - remaining}/{total} pages", end="", file=stderr)
+
+        partial = destination + ".partial"
+        target = sqlite3.connect(partial)
+        try:
+            self.db.backup(target, pages=pages, progress=progress)
+            print(file=stderr)
+            if verify:
+                result = target.execute("PRAGMA integrity_check").fetchone()[0]
+                if result != "ok":
+                    raise Database.DatabaseError(f"The backup is damaged: {result}")
+        except sqlite3.Error as error:
+            raise Database.DatabaseError(f"An sqlite3 error occurred: {error.args[0]}")
+        finally:
+            target.close()
 
-        print("Upgrade complete.", file=stderr)
+        if compress:
+            with open(partial, "rb") as source, gzip.open(destination, "wb") as gzipped:
+                shutil.copyfileobj(source, gzipped)
+            os.remove(partial)
+        else:
+            os.replace(partial, destination)
+        return True
 
     def commit(self):  # {{{2
         """ Save any changes to the database that have not yet been committed. """
 
         if self.is_open:
             self.db.commit()
+            try:
+                self.write_back()
+            finally:
+                self._release_writer()
+
+    def rollback(self):  # {{{2
+        """ Discard any changes to the database that have not yet been committed. """
+
+        if self.is_open:
+            self.db.rollback()
+            self._release_writer()
 
     def close(self):  # {{{2
-        """ Close the instance's database connection. """
+        """ Close all of the instance's database connections. """
 
-        if self.db and self.is_open:
-            self.db.commit()
-            self.db.close()
-            self.db = None
-            self.is_open = False
+        if self.is_open:
+            with self._connections_lock:
+                for connection in self._connections:
+                    connection.commit()
+            try:
+                self.write_back()
+            finally:
+                with self._connections_lock:
+                    for connection in self._connections:
+                        connection.close()
+                    self._connections = []
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._local = threading.local()
+                self._writer_lock = threading.Lock()
+                self.is_open = False
 
     def execute(self, query, args=None, commit=False, debug=False):  # {{{2
         """ Execute a query on the database and evaluate the result. """
@@ -175,6 +708,9 @@ class Database:  # {{{1
         if not self.is_open and not self.open():
             return False
         cursor = self.db.cursor()
+        if not query.lstrip()[:7].lower().startswith(_READ_STATEMENTS):
+            self._acquire_writer()
+            self._changes += 1
         if debug:
             print(query)
         if args:
@@ -189,7 +725,7 @@ class Database:  # {{{1
         else:
             row = cursor.execute(query)
         if commit and query.lower()[0:6] in ("insert", "update", "delete"):
-            self.db.commit()
+            self.commit()
         return row
 
     def get_one(self, query, args=None):  # {{{2
@@ -201,117 +737,823 @@ class Database:  # {{{1
     def parse_arguments(self, args):  # {{{2
         """ Evaluate given arguments and set appropriate option variables. """
 
-        self.filters = {}
-        self.exact_author = args.exactauthor
-        self.keywords_or = args.orkeyword
-        if args.author:
-            self.filters["author"] = args.author
-        if args.keyword:
-            self.filters["keywords"] = args.keyword
-        if args.lang:
-            self.filters["language"] = args.lang
-        if args.text:
-            self.filters["text"] = args.text
+        query = TaglineQuery.from_arguments(self, args)
+        self.filters = query.filters
+        self.exact_author = query.exact_author
+        self.keywords_or = query.keywords_or
+
+    def _watermarks(self):  # {{{2
+        row = self.get_one("SELECT value FROM status WHERE id=?", (_STATUS_WATERMARK,))
+        return json.loads(row[0]) if row else {}
+
+    def watermark(self, key):  # {{{2
+        """ Return the ID of the newest line seen by the last run with --new
+        and the filters of the given TaglineQuery.watermark_key(). """
+
+        return self._watermarks().get(key, 0)
+
+    def set_watermark(self, line_id, key):  # {{{2
+        """ Store the ID of the newest line seen with some filters, see watermark(). """
+
+        self.execute("BEGIN")
+        watermarks = self._watermarks()
+        watermarks[key] = line_id
+        self.execute(
+            "INSERT OR REPLACE INTO status (id, value) VALUES (?, ?)",
+            (_STATUS_WATERMARK, json.dumps(watermarks)), commit=True)
+
+    def _load_text_codecs(self):  # {{{2
+        """ Read the text compression of all schemas from their status tables. """
+
+        codecs = {}
+        self._text_codec = None
+        for schema in self.schemas:
+            rows = dict(self.execute(
+                f"SELECT id, value FROM {schema}.status WHERE id IN (?, ?)",
+                (_STATUS_TEXT_CODEC, _STATUS_TEXT_DICTIONARY)))
+            if _STATUS_TEXT_CODEC in rows:
+                codec = TextCodec(rows[_STATUS_TEXT_CODEC], rows[_STATUS_TEXT_DICTIONARY])
+                codecs[codec.id] = codec
+                if schema == "main":
+                    self._text_codec = codec
+        self._text_codecs = codecs
+
+    @property
+    def text_codec(self):  # {{{2
+        """ The TextCodec with which new texts are compressed, or None. """
+
+        if not self.is_open:
+            self.open()
+        return self._text_codec
+
+    def set_text_codec(self, codec):  # {{{2
+        """ Compress new texts with the TextCodec, or no longer if it is None, without committing.
+
+        Texts compressed with a previous codec must have been decompressed before. """
+
+        if codec is None:
+            self.execute("DELETE FROM status WHERE id IN (?, ?)",
+                         (_STATUS_TEXT_CODEC, _STATUS_TEXT_DICTIONARY))
+        else:
+            self.execute("INSERT OR REPLACE INTO status (id, value) VALUES (?, ?), (?, ?)", (
+                _STATUS_TEXT_CODEC, codec.name, _STATUS_TEXT_DICTIONARY, codec.dictionary))
+            self._text_codecs[codec.id] = codec
+        self._text_codec = codec
+
+    def pack_text(self, text):  # {{{2
+        """ Return the value to store in lines.text for a text. """
+
+        return text if self._text_codec is None else self._text_codec.compress(text)
+
+    def unpack_text(self, value):  # {{{2
+        """ Return the text of a value of lines.text, which may be compressed.
+
+        This is also the SQL function unpack_text() of every connection. """
+
+        if not isinstance(value, bytes):
+            return value
+        codec = self._text_codecs.get(dictionary_id(value))
+        if codec is None:
+            raise Database.DatabaseError("A text is compressed with an unknown dictionary.")
+        return codec.decompress(value)
+
+    def query(self):  # {{{2
+        """ Return a TaglineQuery with the set filters. """
+
+        return TaglineQuery(self, self.filters, self.exact_author, self.keywords_or)
+
+    def languages(self):  # {{{2
+        """ Return the list of preferred languages, see TaglineQuery.languages(). """
+
+        return self.query().languages()
+
+    def filter_key(self):  # {{{2
+        """ Return a hashable, normalised representation of the set filters. """
+
+        return self.query().key()
+
+    def use_bitmap_index(self, enabled=True):  # {{{2
+        """ Let queries on keywords, one language and authors use in-memory bitmaps.
+
+        The bitmaps are loaded on first use and then updated from the change
+        log, which pays off for many queries on the same Database. """
+
+        with self._cache_lock:
+            self._bitmap_indexes = {} if enabled else None
+
+    def bitmap_index(self, schema="main"):  # {{{2
+        """ Return the BitmapIndex of a schema, or None if they are not enabled. """
+
+        with self._cache_lock:
+            if self._bitmap_indexes is None:
+                return None
+            if schema not in self._bitmap_indexes:
+                self._bitmap_indexes[schema] = BitmapIndex(self, schema)
+            return self._bitmap_indexes[schema]
+
+    def compiled(self, key, schema, compile_filters):  # {{{2
+        """ Return the compiled SQL of a filter set, calling compile_filters only once. """
+
+        with self._cache_lock:
+            result = self._compiled.get((key, schema))
+            if result is not None:
+                self._compiled.move_to_end((key, schema))
+                return result
+        result = compile_filters()
+        with self._cache_lock:
+            self._compiled[(key, schema)] = result
+            if len(self._compiled) > _CACHE_SIZE:
+                self._compiled.popitem(last=False)
+        return result
+
+    def _change_stamp(self):  # {{{2
+        """ Return a number which changes whenever the database is modified.
+
+        Changes through this object are counted in execute(), those of other
+        connections are detected with PRAGMA data_version. """
+
+        data_version = self.get_one("PRAGMA data_version")[0]
+        if data_version != getattr(self._local, "data_version", data_version):
+            self._changes += 1
+        self._local.data_version = data_version
+        return self._changes
+
+    def cached_line_ids(self, key, fetch):  # {{{2
+        """ Return the matching line IDs of a filter set, calling fetch if unknown.
+
+        The result is cached per filter set until the database changes. """
+
+        stamp = self._change_stamp()
+        with self._cache_lock:
+            if stamp != self._cache_stamp:
+                self._cache.clear()
+                self._cache_stamp = stamp
+            ids = self._cache.get(key)
+            if ids is not None:
+                self._cache.move_to_end(key)
+                return ids
+
+        ids = fetch()
+
+        with self._cache_lock:
+            if stamp == self._cache_stamp:
+                self._cache[key] = ids
+                if len(self._cache) > _CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return ids
+
+    def line_ids(self):  # {{{2
+        """ Return the IDs of all lines matching the set filters, see TaglineQuery.line_ids(). """
+
+        return self.query().line_ids()
 
     def random_tagline(self):  # {{{2
-        """ Retrieve and return a random tagline text from the database. """
+        """ Retrieve and return a random tagline text from the database.
 
-        cursor = self.taglines(True)
-        if cursor:
-            result = cursor.fetchone()
-            if result:
-                return result[0]
-        return None
+        With attached databases, each is chosen with a probability relative
+        to its number of matching lines. """
+
+        return self.query().random()
+
+    def random_record(self):  # {{{2
+        """ Return a TaglineRecord of a random line matching the set filters, or None. """
+
+        return self.query().random_record()
+
+    def count(self, by=None):  # {{{2
+        """ Count the lines and taglines matching the set filters, see TaglineQuery.counts(). """
+
+        return self.query().counts(by)
 
     def taglines(self, random=False):  # {{{2
         """ Retrieve and return taglines according to set filters. """
 
-        query = "SELECT text FROM lines AS l"
+        return self.query().select(random)
+
+    def records(self):  # {{{2
+        """ Return a TaglineRecord for every line matching the set filters. """
+
+        return self.query().records()
+
+    def has_table(self, name, schema="main"):  # {{{2
+        """ Return whether a table of the given name exists. """
+
+        return self.get_one(
+            f"SELECT 1 FROM {schema}.sqlite_master WHERE name=?", (name,)) is not None
+
+    def find_names(self, table, needle, limit=10, schema="main"):  # {{{2
+        """ Find authors or keywords by (part of) their name.
+
+        Returns a list of (id, name) tuples: all names containing the needle,
+        exact and prefix matches first; or, if there are none, up to limit
+        names that are similar to it, best first. Like texts, names are
+        compared case-folded and without diacritics. """
+
+        column, index = NAME_INDEXES[table]
+        folded = search_text(needle)
+        if len(folded) >= 3 and self.has_table(index, schema):
+            rows = self.execute(
+                f"SELECT t.id, t.{column}, t.search FROM {schema}.{index} JOIN {schema}.{table} AS t "
+                f"ON t.id={index}.rowid WHERE {index}.search LIKE ?",
+                (f"%{folded}%",)).fetchall()
+        else:
+            rows = self.execute(
+                f"SELECT id, {column}, search FROM {schema}.{table} WHERE search LIKE ?",
+                (f"%{folded}%",)).fetchall()
+        if rows:
+            return [(row_id, name) for row_id, name, _ in sorted(rows, key=lambda row: (
+                row[2] != folded, not row[2].startswith(folded), len(row[1]), row[1]))]
+
+        # typo tolerance: candidates share at least one trigram with the
+        # needle, and are ranked by the share of common trigrams with the
+        # whole name or its best matching word
+        wanted = trigrams(needle)
+        rows = []
+        if self.has_table(index, schema):
+            terms = " OR ".join('"' + gram.replace('"', '""') + '"'
+                                for gram in wanted if " " not in gram)
+            if terms:
+                rows = self.execute(
+                    f"SELECT t.id, t.{column} FROM {schema}.{index} JOIN {schema}.{table} AS t "
+                    f"ON t.id={index}.rowid WHERE {index} MATCH ? ORDER BY rank LIMIT 200",
+                    (terms,)).fetchall()
+        if not rows:
+            rows = self.execute(f"SELECT id, {column} FROM {schema}.{table}").fetchall()
+
+        scored = []
+        for row in rows:
+            score = max(len(wanted & grams) / len(wanted | grams) for grams in
+                        [trigrams(row[1])] + [trigrams(word) for word in (row[1] or "").split()])
+            if score >= 0.25:
+                scored.append((-score, row[1], row[0]))
+        return [(row_id, name) for _, name, row_id in sorted(scored)[:limit]]
+
+    def search(self, needle):  # {{{2
+        """ Return the IDs of all taglines with a text containing the needle.
+
+        Case and diacritics are ignored. """
+
+        if self.has_table("lines_search"):
+            query = "SELECT DISTINCT l.tagline FROM lines_search JOIN lines AS l ON l.id=lines_search.rowid WHERE lines_search.search LIKE ?"
+        else:
+            query = "SELECT DISTINCT tagline FROM lines WHERE search LIKE ?"
+        cursor = self.execute(query + " ORDER BY 1", (f"%{search_text(needle)}%",))
+        return [row[0] for row in cursor]
+
+    def find_text(self, text):  # {{{2
+        """ Return the IDs of all taglines which already contain the text. """
+
+        cursor = self.execute(
+            "SELECT DISTINCT tagline FROM lines WHERE hash=? ORDER BY tagline",
+            (content_hash(text),))
+        return [row[0] for row in cursor]
+
+    def duplicates(self):  # {{{2
+        """ Yield (tagline IDs, text) for every text that occurs repeatedly. """
+
+        cursor = self.execute(
+            """SELECT group_concat(DISTINCT tagline), unpack_text(text) FROM lines
+            GROUP BY hash HAVING count(DISTINCT tagline) > 1 ORDER BY min(tagline)""")
+        for taglines, text in cursor:
+            yield sorted(int(tagline) for tagline in taglines.split(",")), text
+
+    def _merged(self, query, by_name):  # {{{2
+        """ Run the query on all schemas and yield the merged rows.
+
+        If by_name is set, every query must be sorted by its first column, and
+        the rows are merged into one sorted stream without repetitions. """
+
+        cursors = [self.execute(query.format(schema=schema)) for schema in self.schemas]
+        if not by_name:
+            for cursor in cursors:
+                yield from cursor
+            return
+        # rows already seen with the current first column
+        seen = set()
+        previous = None
+        for row in heapq.merge(*cursors, key=lambda row: (row[0] is not None, row[0])):
+            if row[0] != previous:
+                seen.clear()
+                previous = row[0]
+            if row not in seen:
+                seen.add(row)
+                yield row
+
+    def keywords(self, by_name=True):  # {{{2
+        """ Retrieve and return all keywords and their names from the db. """
+
+        query = "SELECT text FROM {schema}.keywords"
+        if by_name:
+            query += " ORDER by text"
+        return (row[0] for row in self._merged(query, by_name))
+
+    def authors(self, by_name=True):  # {{{2
+        """ Retrieve and return all authors and their data from the database. """
+
+        query = "SELECT name, born, died FROM {schema}.authors"
+        if by_name:
+            query += " ORDER BY name"
+        return (name + (
+            f' ({born if born else ""}-{died if died else ""})'
+            if born or died else "") for name, born, died in self._merged(query, by_name))
+
+    def stats(self):  # {{{2
+        """ Calculate and return some statistical data on the database. """
+
+        def total(query):
+            return sum(int(self.get_one(query.format(schema=schema))[0] or 0)
+                       for schema in self.schemas)
+
+        def distinct(query):
+            # UNION removes duplicates only between schemas, not within one
+            union = " UNION ".join(query.format(schema=schema) for schema in self.schemas)
+            return int(self.get_one(f"SELECT count(*) FROM (SELECT DISTINCT * FROM ({union}))")[0])
+
+        stats = {}
+        stats["schema version"] = self.get_version()
+        stats["keyword assignments"] = total("SELECT count(*) FROM {schema}.kw_tl")
+        stats["keyword count"] = distinct("SELECT text FROM {schema}.keywords")
+        stats["tagline count"] = total("SELECT count(*) FROM {schema}.taglines")
+        stats["line count"] = total("SELECT count(*) FROM {schema}.lines")
+        stats["author count"] = distinct("SELECT name, born, died FROM {schema}.authors")
+        stats["language count"] = distinct("SELECT language FROM {schema}.lines")
+
+        linelengthsum = total("SELECT sum(length) FROM {schema}.lines")
+        stats["avg tagline length"] = linelengthsum / stats["line count"] if \
+            stats["line count"] != 0 else 0
+
+        return stats
+
+
+def _record_query(schema, extra_columns=""):  # {{{1
+    """ Return a query for the columns of a TaglineRecord of lines AS r. """
+
+    return f"""SELECT unpack_text(r.text), r.language, a.name, t.source, t.remark, t.date, (
+        SELECT group_concat(k.text, char(31)) FROM {schema}.kw_tl AS kt
+        JOIN {schema}.keywords AS k ON k.id=kt.keyword WHERE kt.tagline=r.tagline
+        ){extra_columns} FROM {schema}.lines AS r
+        LEFT JOIN {schema}.taglines AS t ON t.id=r.tagline
+        LEFT JOIN {schema}.authors AS a ON a.id=t.author"""
+
+
+class TaglineRecord:  # {{{1
+    """ A text together with the information about its tagline. """
+
+    __slots__ = ("text", "language", "author", "source", "remark", "date", "keywords")
+
+    def __init__(self, row):  # {{{2
+        """ @param row: text, language, author, source, remark, date and the
+            keywords separated by char(31), as selected by _record_query() """
+
+        (self.text, self.language, self.author, self.source,
+         self.remark, self.date, keywords) = row[:7]
+        self.keywords = tuple(sorted(keywords.split("\x1f"))) if keywords else ()
+
+    def __repr__(self):  # {{{2
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"TaglineRecord({fields})"
+
+    def format(self, template):  # {{{2
+        """ Fill a str.format() template with the record's fields.
+
+        Missing values become empty strings, and the keywords are joined
+        with commas. """
+
+        fields = {name: "" if getattr(self, name) is None else getattr(self, name)
+                  for name in self.__slots__}
+        fields["keywords"] = ", ".join(self.keywords)
+        return template.format(**fields)
+
+
+class TaglineQuery:  # {{{1
+    """ An immutable selection of lines of a Database.
+
+    Every filter method returns a new query, so queries can be chained and
+    shared. Nothing is read from the database until a query is iterated, which
+    yields the matching texts, or one of its other methods is called. The SQL
+    of a filter set is compiled only once, and the matching line IDs are
+    cached by the Database until it changes. """
+
+    def __init__(self, db, filters=None, exact_author=False, keywords_or=False):  # {{{2
+        self.db = db
+        self._filters = {name: value for name, value in (filters or {}).items()
+                         if value is not None}
+        self.exact_author = exact_author
+        self.keywords_or = keywords_or
+
+    @classmethod
+    def from_arguments(cls, db, args):  # {{{2
+        """ Return the query for the filters given on the command line. """
+
+        query = cls(db, exact_author=args.exactauthor, keywords_or=args.orkeyword)
+        query = query.author(args.author, args.exactauthor)
+        if args.keyword:
+            query = query.keywords(*args.keyword, any_of=args.orkeyword)
+        query = query.where_keywords(args.where_keywords).language(args.lang)
+        if args.text:
+            query = query.text(*args.text)
+        query = query.max_lines(args.max_lines).max_width(args.max_width).max_chars(args.max_chars)
+        query = query.added(args.added_since, args.added_until)
+        query = query.dated(args.dated_since, args.dated_until)
+        if args.new:
+            query = query.new()
+        return query
+
+    def _with(self, **changes):  # {{{2
+        """ Return a copy of the query with some filters replaced. """
+
+        filters = dict(self._filters)
+        filters.update(changes)
+        return TaglineQuery(self.db, filters, self.exact_author, self.keywords_or)
+
+    @property
+    def filters(self):  # {{{2
+        """ A copy of the filters as a dict. """
+
+        return dict(self._filters)
+
+    def author(self, name, exact=False):  # {{{2
+        """ Only lines of taglines by the author, whose name contains name unless exact. """
+
+        query = self._with(author=name or None)
+        query.exact_author = exact
+        return query
+
+    def keywords(self, *names, any_of=False):  # {{{2
+        """ Only lines of taglines with all (or with any_of) the keywords. """
+
+        query = self._with(keywords=list(dict.fromkeys(names)) or None)
+        query.keywords_or = any_of
+        return query
+
+    def where_keywords(self, expression):  # {{{2
+        """ Only lines of taglines whose keywords match a boolean expression. """
+
+        return self._with(keyword_expression=expression or None)
+
+    def language(self, *languages):  # {{{2
+        """ Only lines in the given languages, see languages(). """
+
+        if len(languages) == 1:
+            languages = languages[0]
+        return self._with(language=languages or None)
+
+    def text(self, *needles):  # {{{2
+        """ Only lines which contain all needles, in addition to those already set. """
+
+        return self._with(text=(self._filters.get("text") or []) + list(needles))
+
+    def max_lines(self, count):  # {{{2
+        """ Only lines with at most count lines. """
+
+        return self._with(max_lines=count)
+
+    def max_width(self, columns):  # {{{2
+        """ Only lines whose lines are at most the given number of columns wide. """
+
+        return self._with(max_width=columns)
+
+    def max_chars(self, count):  # {{{2
+        """ Only lines with at most count characters. """
+
+        return self._with(max_chars=count)
+
+    def added(self, since=None, until=None):  # {{{2
+        """ Only lines added or changed within the given ISO dates. """
+
+        return self._with(added_since=since, added_until=until)
+
+    def dated(self, since=None, until=None):  # {{{2
+        """ Only lines of taglines whose date of origin is within the given ISO dates. """
+
+        return self._with(dated_since=since, dated_until=until)
+
+    def new(self):  # {{{2
+        """ Only lines added after the watermark of the Database for the
+        other filters, so it must be the last filter to be set.
+
+        The upper end of the range is the newest line at the time of the
+        call, so that lines added meanwhile are not missed by the next run. """
+
+        return self._with(
+            after_line=self.db.watermark(self.watermark_key()),
+            until_line=self.db.get_one("SELECT max(id) FROM lines")[0] or 0)
+
+    def watermark_key(self):  # {{{2
+        """ Return the key of the watermark of the filters apart from new(). """
+
+        return json.dumps(self._with(after_line=None, until_line=None).key())
+
+    def languages(self):  # {{{2
+        """ Return the list of preferred languages from the language filter.
+
+        The filter is a comma separated string or a list, in which "*" stands
+        for any other language. """
+
+        languages = self._filters.get("language") or []
+        if isinstance(languages, str):
+            languages = languages.split(",")
+        return [language.strip() for language in languages if language.strip()]
+
+    def key(self):  # {{{2
+        """ Return a hashable, normalised representation of the filters. """
+
+        filters = self._filters
+        author = filters.get("author")
+        keywords = tuple(sorted(set(filters.get("keywords") or ())))
+        return (
+            author, bool(author and self.exact_author),
+            keywords, len(keywords) > 1 and self.keywords_or,
+            tuple(self.languages()),
+            tuple(sorted(set(filters.get("text") or ()))),
+            filters.get("keyword_expression"),
+            tuple(filters.get(name) for name in _SIZE_FILTERS),
+            tuple(filters.get(name) for name in _DATE_FILTERS),
+            filters.get("after_line"), filters.get("until_line"))
+
+    def compile(self, schema="main"):  # {{{2
+        """ Return the SQL to append after "FROM <schema>.lines AS l" and its arguments.
+
+        The result is cached by the Database. """
+
+        return self.db.compiled(self.key(), schema, lambda: self._compile(schema))
+
+    def _compile(self, schema):  # {{{2
+        """ Translate the filters into joins and conditions on lines AS l. """
+
+        filters = self._filters
+        query = ""
         qargs = []
         where = []
 
-        author = self.filters.get("author")
+        author = filters.get("author")
+        if author or any(filters.get(name) for name in ("dated_since", "dated_until")):
+            query += f" JOIN {schema}.taglines AS tl ON l.tagline=tl.id"
         if author:
-            query += " JOIN taglines AS tl ON l.tagline=tl.id"
             if self.exact_author:
-                query += " JOIN authors a ON a.name=? AND tl.author=a.id"
+                query += f" JOIN {schema}.authors a ON a.name=? AND tl.author=a.id"
                 qargs.append(author)
+            elif len(search_text(author)) >= 3 and self.db.has_table("author_names", schema):
+                query += f" AND tl.author IN (SELECT rowid FROM {schema}.author_names WHERE search LIKE ?)"
+                qargs.append("%" + search_text(author) + "%")
             else:
-                query += " JOIN authors a ON a.name LIKE ? AND tl.author=a.id"
-                qargs.append("%" + author + "%")
+                query += f" JOIN {schema}.authors a ON a.search LIKE ? AND tl.author=a.id"
+                qargs.append("%" + search_text(author) + "%")
 
-        keywords = self.filters.get("keywords")
+        # without duplicates, which would never reach the count of HAVING
+        keywords = list(dict.fromkeys(filters.get("keywords") or ()))
         if keywords:
             where.append(
                 f"""l.tagline IN (
-                SELECT tagline FROM kw_tl JOIN keywords ON kw_tl.keyword=keywords.id
-                WHERE text IN ({",".join(["?"] * len(keywords))})
+                SELECT tagline FROM {schema}.kw_tl AS kt JOIN {schema}.keywords AS k ON kt.keyword=k.id
+                WHERE k.text IN ({",".join(["?"] * len(keywords))})
                 GROUP BY tagline{"" if self.keywords_or else " HAVING count(*)=?"}
                 )""")
             qargs += keywords
             if not self.keywords_or:
                 qargs.append(len(keywords))
 
-        text = self.filters.get("text")
+        expression = filters.get("keyword_expression")
+        if expression:
+            try:
+                tree = keyword_expression.parse(expression)
+            except keyword_expression.ParseError as error:
+                raise Database.DatabaseError(f"Invalid keyword expression: {error}") from error
+            subquery, subargs = keyword_expression.compile_sql(tree, schema)
+            where.append(f"l.tagline IN ({subquery})")
+            qargs += subargs
+
+        # conditions on the line itself, as opposed to its tagline
+        line_where = []
+        line_args = []
+        text = filters.get("text")
         if text:
-            where.extend(["text like ?"] * len(text))
+            if self.db.has_table("lines_search", schema):
+                line_where.extend([f"l.id IN (SELECT rowid FROM {schema}.lines_search WHERE search LIKE ?)"] * len(text))
+            else:
+                line_where.extend(["l.search LIKE ?"] * len(text))
             for keyword in text:
                 if not keyword.startswith('%') and not keyword.endswith('%'):
                     keyword = '%' + keyword + '%'
-                qargs.append(keyword)
-
-        lang = self.filters.get("language")
-        if lang:
-            where.append("l.language=?")
-            qargs.append(lang)
+                line_args.append(search_text(keyword))
+
+        for name, column in _SIZE_FILTERS.items():
+            if filters.get(name) is not None:
+                line_where.append(f"l.{column}<=?")
+                line_args.append(filters[name])
+
+        for name, condition in _DATE_FILTERS.items():
+            if filters.get(name):
+                if condition.startswith("l."):
+                    line_where.append(condition)
+                    line_args.append(filters[name])
+                else:
+                    where.append(condition)
+                    qargs.append(filters[name])
+
+        if filters.get("until_line") is not None:
+            line_where.append("l.id>? AND l.id<=?")
+            line_args += [filters.get("after_line", 0), filters["until_line"]]
+
+        # a "*" on its own allows any language and needs no condition
+        languages = self.languages()
+        ranked = [language for language in languages if language != "*"]
+        if len(languages) == 1 and ranked:
+            line_where.append("l.language=?")
+            line_args.append(languages[0])
+        elif ranked:
+            # the best ranked of the lines of each tagline which match the
+            # other conditions, in one pass over the index
+            ranking = " ".join(f"WHEN ? THEN {rank}" for rank in range(len(ranked)))
+            if "*" not in languages:
+                line_where.insert(0, f"l.language IN ({','.join('?' * len(ranked))})")
+                line_args[:0] = ranked
+            where.append(
+                f"""l.id IN (SELECT id FROM (
+                SELECT l.id, row_number() OVER (
+                    PARTITION BY l.tagline
+                    ORDER BY CASE l.language {ranking} ELSE {len(ranked)} END, l.language, l.id
+                ) AS rank FROM {schema}.lines AS l
+                {"WHERE " + " AND ".join(line_where) if line_where else ""}
+                ) WHERE rank=1)""")
+            qargs += ranked + line_args
+            line_where = []
+            line_args = []
+        where += line_where
+        qargs += line_args
 
         if where:
             query += " WHERE " + " AND ".join(where)
+        return query, qargs
+
+    def _listing(self, columns, random=False):  # {{{2
+        """ Return the query for columns of all matching lines AS l in all schemas. """
 
+        queries = []
+        qargs = []
+        for number, schema in enumerate(self.db.schemas):
+            query, args = self.compile(schema)
+            queries.append(
+                f"SELECT {columns}, {number} AS db, l.tagline AS tagline, l.language AS language "
+                f"FROM {schema}.lines AS l" + query)
+            qargs += args
+        query = " UNION ALL ".join(queries)
         if random:
             query += " ORDER BY RANDOM() LIMIT 1"
         else:
-            query += " ORDER BY l.tagline, l.language"
+            query += " ORDER BY db, tagline, language"
+        return query, qargs
 
-        return self.execute(query, (qargs))
+    def select(self, random=False):  # {{{2
+        """ Execute the query and return a cursor over rows of the texts.
 
-    def keywords(self, by_name=True):  # {{{2
-        """ Retrieve and return all keywords and their names from the db. """
+        They are ordered by database, tagline and language, or, if random, a
+        single random row is returned. """
 
-        query = "SELECT text FROM keywords"
-        if by_name:
-            query += " ORDER by text"
-        return (row[0] for row in self.execute(query))
+        query, qargs = self._listing("l.text", random)
+        return self.db.execute(f"SELECT unpack_text(text) FROM ({query})", qargs)
 
-    def authors(self, by_name=True):  # {{{2
-        """ Retrieve and return all authors and their data from the database. """
+    def __iter__(self):  # {{{2
+        return (row[0] for row in self.select())
 
-        query = "SELECT name, born, died FROM authors"
-        if by_name:
-            query += " ORDER BY name"
-        return (name + (
-            f' ({born if born else ""}-{died if died else ""})'
-            if born or died else "") for name, born, died in self.execute(query))
+    def records(self):  # {{{2
+        """ Return a TaglineRecord for every matching line, in the order of iteration. """
 
-    def stats(self):  # {{{2
-        """ Calculate and return some statistical data on the database. """
+        queries = []
+        qargs = []
+        for number, schema in enumerate(self.db.schemas):
+            query, args = self.compile(schema)
+            queries.append(
+                _record_query(schema, f", {number} AS db, r.tagline")
+                + f" WHERE r.id IN (SELECT l.id FROM {schema}.lines AS l{query})")
+            qargs += args
+        query = " UNION ALL ".join(queries) + " ORDER BY db, tagline, language"
+        return (TaglineRecord(row) for row in self.db.execute(query, qargs))
 
-        stats = {}
-        stats["schema version"] = self.get_version()
-        stats["keyword assignments"] = int(self.get_one("SELECT count(*) FROM kw_tl")[0])
-        stats["keyword count"] = int(self.get_one("SELECT count(*) FROM keywords")[0])
-        stats["tagline count"] = int(self.get_one("SELECT count(*) FROM taglines")[0])
-        stats["line count"] = int(self.get_one("SELECT count(*) FROM lines")[0])
-        stats["author count"] = int(self.get_one("SELECT count(*) FROM authors")[0])
-        stats["language count"] = int(self.get_one(
-            "SELECT COUNT(*) FROM (SELECT DISTINCT language FROM lines)")[0])
-
-        cursor = self.execute("SELECT text FROM lines")
-        linelengthsum = sum(len(row[0]) for row in cursor)
-        stats["avg tagline length"] = linelengthsum / stats["line count"] if \
-            stats["line count"] != 0 else 0
+    def line_ids(self):  # {{{2
+        """ Return the IDs of all matching lines, as a list of one array per schema. """
 
-        return stats
+        return self.db.cached_line_ids(self.key(), self._fetch_line_ids)
+
+    def _bitmap(self, schema):  # {{{2
+        """ Return the BitmapIndex and bitmap of the matching lines, or None if not usable. """
+
+        index = self.db.bitmap_index(schema)
+        if index is None or not index.supports(self._filters):
+            return None
+        return index, index.select(self._filters, self.exact_author, self.keywords_or)
+
+    def _fetch_line_ids(self):  # {{{2
+        ids = []
+        for schema in self.db.schemas:
+            bitmap = self._bitmap(schema)
+            if bitmap is not None:
+                ids.append(bitmap[0].line_ids_of(bitmap[1]))
+                continue
+            query, qargs = self.compile(schema)
+            ids.append(array("l", (row[0] for row in self.db.execute(
+                f"SELECT l.id FROM {schema}.lines AS l" + query, qargs))))
+        return ids
+
+    def count(self):  # {{{2
+        """ Return the number of matching lines, counted by sqlite or the bitmap index. """
+
+        total = 0
+        for schema in self.db.schemas:
+            bitmap = self._bitmap(schema)
+            if bitmap is not None:
+                total += bitmap[1].bit_count()
+                continue
+            query, qargs = self.compile(schema)
+            total += self.db.get_one(f"SELECT count(*) FROM {schema}.lines AS l" + query, qargs)[0]
+        return total
+
+    def counts(self, by=None):  # {{{2
+        """ Count the matching lines and their distinct taglines with sqlite.
+
+        Without by, a tuple of both numbers is returned. With by="language"
+        or by="keyword", a dict maps each language or keyword to such a
+        tuple, computed with one grouped query per schema. Lines of taglines
+        without keywords are not counted by keyword. """
+
+        total = {}
+        for schema in self.db.schemas:
+            query, qargs = self.compile(schema)
+            if by is None:
+                select = (f"SELECT NULL, count(*), count(DISTINCT l.tagline) "
+                          f"FROM {schema}.lines AS l{query}")
+            elif by == "language":
+                select = (f"SELECT l.language, count(*), count(DISTINCT l.tagline) "
+                          f"FROM {schema}.lines AS l{query} GROUP BY l.language")
+            elif by == "keyword":
+                select = (f"""SELECT k.text, count(*), count(DISTINCT m.tagline)
+                          FROM (SELECT l.tagline FROM {schema}.lines AS l{query}) AS m
+                          JOIN {schema}.kw_tl AS kt ON kt.tagline=m.tagline
+                          JOIN {schema}.keywords AS k ON k.id=kt.keyword GROUP BY k.text""")
+            else:
+                raise ValueError(f"Cannot count by {by}.")
+            for name, lines, taglines in self.db.execute(select, qargs):
+                previous = total.get(name, (0, 0))
+                total[name] = (previous[0] + lines, previous[1] + taglines)
+        if by is None:
+            return total.get(None, (0, 0))
+        return total
+
+    def exists(self):  # {{{2
+        """ Return whether any line matches, stopping at the first one. """
+
+        for schema in self.db.schemas:
+            query, qargs = self.compile(schema)
+            if self.db.get_one(
+                    f"SELECT EXISTS (SELECT 1 FROM {schema}.lines AS l{query})", qargs)[0]:
+                return True
+        return False
+
+    def _lines(self, count):  # {{{2
+        """ Return the schema and ID of up to count different random matching lines.
+
+        With attached databases, the lines of all of them are equally likely. """
+
+        schema_ids = self.line_ids()
+        total = sum(len(ids) for ids in schema_ids)
+        lines = []
+        for index in sample(range(total), min(count, total)):
+            for schema, ids in zip(self.db.schemas, schema_ids):
+                if index < len(ids):
+                    lines.append((schema, ids[index]))
+                    break
+                index -= len(ids)
+        return lines
+
+    def sample(self, count):  # {{{2
+        """ Return the texts of up to count different random matching lines. """
+
+        texts = []
+        for schema, line_id in self._lines(count):
+            row = self.db.get_one(f"SELECT unpack_text(text) FROM {schema}.lines WHERE id=?", (line_id,))
+            if row:
+                texts.append(row[0])
+        return texts
+
+    def random(self):  # {{{2
+        """ Return the text of a random matching line, or None. """
+
+        texts = self.sample(1)
+        return texts[0] if texts else None
+
+    def random_record(self):  # {{{2
+        """ Return a TaglineRecord of a random matching line, or None. """
+
+        for schema, line_id in self._lines(1):
+            row = self.db.get_one(_record_query(schema) + " WHERE r.id=?", (line_id,))
+            return TaglineRecord(row) if row else None
+        return None
+
+    def explain(self):  # {{{2
+        """ Return sqlite's plan for listing the matching lines, one step per line. """
+
+        query, qargs = self._listing("l.text")
+        return "\n".join(row[3] for row in self.db.execute("EXPLAIN QUERY PLAN " + query, qargs))
 
 
 class DatabaseTagline:  # {{{1
@@ -357,7 +1599,7 @@ class DatabaseTagline:  # {{{1
             self.keywords = set(keyword[0] for keyword in cursor)
 
             cursor = self.db.execute(
-                "SELECT language, text FROM lines WHERE tagline=?", (self.id,))
+                "SELECT language, unpack_text(text) FROM lines WHERE tagline=?", (self.id,))
             for row in cursor:
                 self.texts[row[0]] = [row[1], False]
 
@@ -423,8 +1665,10 @@ class DatabaseTagline:  # {{{1
             self.is_changed = True
             self.keywords = new_keywords
 
-    def commit(self):  # {{{2
-        """ Write changed data to database. """
+    def write(self):  # {{{2
+        """ Write changed data to database without committing it.
+
+        This allows callers to collect many taglines in one transaction. """
 
         if self.id is None:
             cursor = self.db.execute(
@@ -452,13 +1696,15 @@ class DatabaseTagline:  # {{{1
             if lang in present_languages:
                 if text[1]:
                     self.db.execute(
-                        "UPDATE lines set date=?, text=? WHERE tagline=? AND language=?",
-                        (date.today().isoformat(), text[0], self.id, lang))
+                        f"UPDATE lines set date=?, text=?, {', '.join(c + '=?' for c in DERIVED_COLUMNS)} WHERE tagline=? AND language=?",
+                        (date.today().isoformat(), self.db.pack_text(text[0]))
+                        + derived_values(text[0]) + (self.id, lang))
                 present_languages.remove(lang)
             else:
                 self.db.execute(
-                    "INSERT INTO lines (tagline, date, language, text) VALUES (?,?,?,?)",
-                    (self.id, date.today().isoformat(), lang, text[0]))
+                    f"INSERT INTO lines (tagline, date, language, text, {', '.join(DERIVED_COLUMNS)}) VALUES (?,?,?,?{',?' * len(DERIVED_COLUMNS)})",
+                    (self.id, date.today().isoformat(), lang, self.db.pack_text(text[0]))
+                    + derived_values(text[0]))
             text[1] = False
         for lang in present_languages:
             self.db.execute("DELETE FROM lines WHERE tagline=? AND language=?", (self.id, lang))
@@ -471,5 +1717,19 @@ class DatabaseTagline:  # {{{1
         for keyword in present_keywords:
             self.db.execute("DELETE FROM kw_tl WHERE keyword=? AND tagline=?", (keyword, self.id))
 
-        self.db.commit()
         self.is_changed = False
+
+    def delete(self):  # {{{2
+        """ Delete the tagline with its texts and keyword assignments without committing. """
+
+        self.db.execute("DELETE FROM kw_tl WHERE tagline=?", (self.id,))
+        self.db.execute("DELETE FROM lines WHERE tagline=?", (self.id,))
+        self.db.execute("DELETE FROM taglines WHERE id=?", (self.id,))
+        self.id = None
+        self.texts = {}
+
+    def commit(self):  # {{{2
+        """ Write changed data to database. """
+
+        self.write()
+        self.db.commit()
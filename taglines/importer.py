@@ -0,0 +1,160 @@
+""" Parallel import of fortune files and mbox signatures into a database. """
+
+import mailbox
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date
+from sys import stderr
+
+from taglines.database import DERIVED_COLUMNS, derived_values, normalise_text
+
+# a line with only a percent sign separates two items in a fortune file
+_FORTUNE_SEPARATOR = re.compile(r"^%[ \t]*$", re.MULTILINE)
+# the signature separator as defined by RFC 3676
+_SIGNATURE_SEPARATOR = re.compile(r"^-- $", re.MULTILINE)
+
+
+def _mbox_signatures(path):  # {{{1
+    """ Yield the signature block of every message in an mbox file. """
+
+    for message in mailbox.mbox(path, create=False):
+        for part in message.walk():
+            if part.get_content_type() != "text/plain":
+                continue
+            payload = part.get_payload(decode=True)
+            if payload is None:
+                continue
+            body = payload.decode(
+                part.get_content_charset() or "utf-8", errors="replace")
+            signature = _SIGNATURE_SEPARATOR.split(body)
+            if len(signature) > 1:
+                yield signature[-1]
+            break
+
+
+def parse_file(path):  # {{{1
+    """ Parse one input file and return its normalised texts.
+
+    This runs in a worker process. The result is a tuple of the path and a
+    list of (derived values, text) tuples in file order, see
+    derived_values(). """
+
+    with open(path, encoding="utf-8", errors="replace") as handle:
+        content = handle.read()
+
+    if content.startswith("From "):
+        texts = _mbox_signatures(path)
+    else:
+        texts = _FORTUNE_SEPARATOR.split(content)
+
+    result = []
+    for text in texts:
+        text = normalise_text(text)
+        if text:
+            result.append((derived_values(text), text))
+    return path, result
+
+
+class Importer:  # {{{1
+    """ Import many text files into a database at once.
+
+    Parsing happens in a pool of worker processes, while this process is the
+    only writer and inserts the taglines in large transactions. At most
+    max_pending parsed files are held in memory; further files are only handed
+    to the workers once the writer has caught up. """
+
+    def __init__(self, db, language, author=None, keywords=None,  # {{{2
+                 jobs=None, batch_size=1000, max_pending=None):
+        self.db = db
+        self.language = language
+        self.author = author
+        self.keywords = set() if keywords is None else set(keywords)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * self.jobs
+        self.imported = 0
+        self.skipped = 0
+        self._seen = set()
+        self._uncommitted = 0
+        self._insert_line = (
+            f"INSERT INTO lines (tagline, date, language, text, "
+            f"{', '.join(DERIVED_COLUMNS)}) "
+            f"VALUES (?,?,?,?{',?' * len(DERIVED_COLUMNS)})")
+
+    def _insert(self, items):  # {{{2
+        """ Write the parsed items of one file, skipping duplicates.
+
+        The rows are inserted directly instead of through DatabaseTagline,
+        which would compute the derived values of every text again. """
+
+        today = date.today().isoformat()
+        for values, text in items:
+            text_hash = values[DERIVED_COLUMNS.index("hash")]
+            if text_hash in self._seen:
+                self.skipped += 1
+                continue
+            self._seen.add(text_hash)
+            tagline = self.db.execute(
+                "INSERT INTO taglines (author) VALUES (?)",
+                (self.author,)).lastrowid
+            self.db.execute(
+                self._insert_line,
+                (tagline, today, self.language, self.db.pack_text(text))
+                + values)
+            for keyword in self.keywords:
+                self.db.execute(
+                    "INSERT INTO kw_tl (keyword, tagline) VALUES (?,?)",
+                    (keyword, tagline))
+            self.imported += 1
+            self._uncommitted += 1
+            if self._uncommitted >= self.batch_size:
+                self.db.commit()
+                self._uncommitted = 0
+
+    def run(self, paths, progress=True):  # {{{2
+        """ Import the given files and return the number of new taglines. """
+
+        paths = list(paths)
+        # texts already in the database count as duplicates as well
+        self._seen.update(
+            row[0] for row in self.db.execute("SELECT hash FROM lines"))
+        start = time.monotonic()
+        done = 0
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            queue = iter(paths)
+            pending = set()
+            while True:
+                while len(pending) < self.max_pending:
+                    path = next(queue, None)
+                    if path is None:
+                        break
+                    pending.add(pool.submit(parse_file, path))
+                if not pending:
+                    break
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done += 1
+                    try:
+                        _path, items = future.result()
+                    except OSError as error:
+                        print(f"\nError reading {error.filename}: "
+                              f"{error.strerror}", file=stderr)
+                        continue
+                    self._insert(items)
+                if progress:
+                    elapsed = time.monotonic() - start
+                    rate = self.imported / elapsed if elapsed else 0
+                    print(f"\r{done}/{len(paths)} files, "
+                          f"{self.imported} taglines ({rate:.0f}/s)",
+                          end="", file=stderr)
+        self.db.commit()
+
+        if progress:
+            elapsed = time.monotonic() - start
+            print(f"\nImported {self.imported} taglines from {done} files in "
+                  f"{elapsed:.1f}s, skipped {self.skipped} duplicates.",
+                  file=stderr)
+        return self.imported
@@ -0,0 +1,142 @@
+""" Boolean expressions over keywords, e.g. "(linux OR unix) AND NOT politics".
+
+An expression is parsed into a tree of tuples:
+    ("keyword", name), ("not", node), ("and", (nodes...)), ("or", (nodes...))
+which can be compiled into an SQL query returning the matching tagline IDs.
+Operators are case-insensitive; keywords containing spaces, parentheses or
+the name of an operator can be written in double quotes. """
+
+import re
+from functools import lru_cache
+
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|"((?:[^"]|"")*)"|([^\s()"]+))')
+_OPERATORS = ("and", "or", "not")
+
+
+class ParseError(Exception):  # {{{1
+    """ Exception that is raised for a malformed expression. """
+
+
+def _tokenize(expression):  # {{{1
+    """ Split the expression into a list of (kind, value) tuples. """
+
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if not match:
+            raise ParseError(
+                f"Unexpected character at position {position + 1}.")
+        opening, closing, quoted, word = match.groups()
+        if opening:
+            tokens.append(("(", None))
+        elif closing:
+            tokens.append((")", None))
+        elif quoted is not None:
+            tokens.append(("keyword", quoted.replace('""', '"')))
+        elif word.lower() in _OPERATORS:
+            tokens.append((word.lower(), None))
+        else:
+            tokens.append(("keyword", word))
+        position = match.end()
+    return tokens
+
+
+@lru_cache(maxsize=64)
+def parse(expression):  # {{{1
+    """ Parse an expression and return its tree. """
+
+    tokens = _tokenize(expression)
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def take(kind):
+        nonlocal position
+        if peek() != kind:
+            found = "end of expression" if peek() is None else f"'{peek()}'"
+            raise ParseError(f"Expected {kind}, found {found}.")
+        position += 1
+        return tokens[position - 1][1]
+
+    def operands(operator, parse_operand):
+        nodes = [parse_operand()]
+        while peek() == operator:
+            take(operator)
+            nodes.append(parse_operand())
+        return nodes[0] if len(nodes) == 1 else (operator, tuple(nodes))
+
+    def parse_or():
+        return operands("or", parse_and)
+
+    def parse_and():
+        return operands("and", parse_not)
+
+    def parse_not():
+        if peek() == "not":
+            take("not")
+            return ("not", parse_not())
+        if peek() == "(":
+            take("(")
+            node = parse_or()
+            take(")")
+            return node
+        return ("keyword", take("keyword"))
+
+    tree = parse_or()
+    if position != len(tokens):
+        kind, value = tokens[position]
+        raise ParseError(f"Unexpected '{value or kind}'.")
+    return tree
+
+
+def keywords(tree):  # {{{1
+    """ Return the set of all keyword names in a tree. """
+
+    if tree[0] == "keyword":
+        return {tree[1]}
+    if tree[0] == "not":
+        return keywords(tree[1])
+    return set().union(*(keywords(node) for node in tree[1]))
+
+
+def compile_sql(tree, schema="main"):  # {{{1
+    """ Compile a tree into a query for the IDs of matching taglines.
+
+    Returns the query and its arguments. Each keyword becomes a lookup in the
+    (keyword, tagline) index of kw_tl, and the operators become the set
+    operations INTERSECT, UNION and EXCEPT. """
+
+    kind = tree[0]
+    if kind == "keyword":
+        return (f"SELECT tagline FROM {schema}.kw_tl WHERE keyword="
+                f"(SELECT id FROM {schema}.keywords WHERE text=?)", [tree[1]])
+
+    if kind == "not":
+        query, qargs = compile_sql(tree[1], schema)
+        return (f"SELECT id FROM {schema}.taglines "
+                f"EXCEPT SELECT * FROM ({query})", qargs)
+
+    if kind == "or":
+        parts = [compile_sql(node, schema) for node in tree[1]]
+        return (" UNION ".join(
+                    f"SELECT * FROM ({query})" for query, _ in parts),
+                [arg for _, qargs in parts for arg in qargs])
+
+    # and: intersect the positive operands, then subtract the negated ones
+    positive = [compile_sql(node, schema)
+                for node in tree[1] if node[0] != "not"]
+    negative = [compile_sql(node[1], schema)
+                for node in tree[1] if node[0] == "not"]
+    if positive:
+        query = " INTERSECT ".join(
+            f"SELECT * FROM ({query})" for query, _ in positive)
+    else:
+        query = f"SELECT id FROM {schema}.taglines"
+    qargs = [arg for _, part_args in positive for arg in part_args]
+    for part_query, part_args in negative:
+        query = f"SELECT * FROM ({query}) EXCEPT SELECT * FROM ({part_query})"
+        qargs += part_args
+    return query, qargs
@@ -0,0 +1,113 @@
+""" Upkeep of a database: statistics for the query planner, removal of
+orphaned rows and reclaiming of free space. """
+
+import time
+from sys import stderr
+
+from taglines.database import NAME_INDEXES
+
+# rows which refer to a row that no longer exists: the table, how to repair
+# them, a condition which selects them and a description for the report
+ORPHANS = (
+    ("lines", "DELETE FROM lines",
+     "NOT EXISTS (SELECT 1 FROM taglines AS t WHERE t.id=lines.tagline)",
+     "texts of deleted taglines"),
+    ("kw_tl", "DELETE FROM kw_tl",
+     """(NOT EXISTS (SELECT 1 FROM taglines AS t WHERE t.id=kw_tl.tagline)
+     OR NOT EXISTS (SELECT 1 FROM keywords AS k WHERE k.id=kw_tl.keyword))""",
+     "keyword assignments of deleted taglines or keywords"),
+    ("taglines", "UPDATE taglines SET author=NULL",
+     """author IS NOT NULL
+     AND NOT EXISTS (SELECT 1 FROM authors AS a WHERE a.id=taglines.author)""",
+     "taglines of deleted authors, whose author was removed"),
+    ("signatures", "DELETE FROM signatures",
+     "NOT EXISTS (SELECT 1 FROM lines AS l WHERE l.id=signatures.line)",
+     "near-duplicate signatures of deleted texts"),
+)
+
+
+def database_size(db):  # {{{1
+    """ Return the size of the database in bytes, including free pages. """
+
+    return (db.get_one("PRAGMA page_size")[0]
+            * db.get_one("PRAGMA page_count")[0])
+
+
+def purge_orphans(db, batch_size=5000):  # {{{1
+    """ Repair all ORPHANS and return the number of repaired rows per
+    description.
+
+    The rows of each table are processed in ranges of batch_size IDs, each
+    range with a single statement in its own transaction, so that other
+    connections are only blocked for short moments. """
+
+    repaired = {}
+    for table, statement, condition, description in ORPHANS:
+        key = "line" if table == "signatures" else "id"
+        if not db.has_table(table):
+            continue
+        count = 0
+        last_id = db.get_one(f"SELECT max({key}) FROM {table}")[0] or 0
+        for start in range(0, last_id, batch_size):
+            cursor = db.execute(
+                f"{statement} WHERE {key}>? AND {key}<=? AND {condition}",
+                (start, start + batch_size))
+            count += cursor.rowcount
+            db.commit()
+        repaired[description] = count
+    return repaired
+
+
+def maintain(db, vacuum=False, batch_size=5000, progress=True):  # {{{1
+    """ Purge orphans, refresh the planner statistics and optionally reclaim
+    space.
+
+    With vacuum, free pages are released by an incremental vacuum if the
+    database uses auto_vacuum=INCREMENTAL, and by a full VACUUM otherwise.
+    Returns a dict with the number of repaired rows per kind of orphan, the
+    file size before and after, and the seconds taken per step. """
+
+    def report(text):
+        if progress:
+            print(text, file=stderr)
+
+    report_data = {"seconds": {}}
+    report_data["size before"] = database_size(db)
+    start = time.monotonic()
+
+    report("Purging orphaned rows...")
+    report_data["orphans"] = purge_orphans(db, batch_size)
+    report_data["seconds"]["orphans"] = time.monotonic() - start
+
+    step = time.monotonic()
+    report("Optimising full-text indexes...")
+    indexes = [index for _, index in NAME_INDEXES.values()]
+    for index in ["lines_search"] + indexes:
+        if db.has_table(index):
+            db.execute(f"INSERT INTO {index} ({index}) VALUES ('optimize')")
+            db.commit()
+    report_data["seconds"]["indexes"] = time.monotonic() - step
+
+    step = time.monotonic()
+    report("Analysing...")
+    db.execute("ANALYZE")
+    db.commit()
+    db.execute("PRAGMA optimize")
+    db.commit()
+    report_data["seconds"]["analyse"] = time.monotonic() - step
+
+    if vacuum:
+        step = time.monotonic()
+        # 2 is INCREMENTAL; VACUUM cannot run inside a transaction
+        if db.get_one("PRAGMA auto_vacuum")[0] == 2:
+            report("Incremental vacuum...")
+            db.execute("PRAGMA incremental_vacuum").fetchall()
+        else:
+            report("Vacuum...")
+            db.execute("VACUUM")
+        db.commit()
+        report_data["seconds"]["vacuum"] = time.monotonic() - step
+
+    report_data["size after"] = database_size(db)
+    report_data["seconds"]["total"] = time.monotonic() - start
+    return report_data
@@ -0,0 +1,158 @@
+""" Detection of texts which are almost, but not exactly, the same.
+
+Every text is reduced to a set of character shingles, of which a MinHash
+signature is computed. Signatures are stored in the database, so only new or
+changed texts need to be processed again. Candidate pairs are found with
+locality sensitive hashing: signatures are cut into bands, and two texts become
+candidates if they agree on all values of at least one band. This avoids
+comparing every text with every other. """
+
+import random
+import re
+import zlib
+from array import array
+from sys import stderr
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+SHINGLE_SIZE = 5
+
+# a Mersenne prime, small enough that a*x+b never overflows 64 bits in numpy
+_PRIME = (1 << 31) - 1
+_rng = random.Random(0x7461676c)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME))
+    for _ in range(NUM_PERMUTATIONS)]
+
+
+def shingles(text):  # {{{1
+    """ Return the set of hashed character shingles of a text.
+
+    Case, punctuation and whitespace layout are ignored. """
+
+    text = " ".join(re.sub(r"[\W_]+", " ", text.casefold()).split())
+    if len(text) <= SHINGLE_SIZE:
+        return {zlib.crc32(text.encode("utf-8"))}
+    return {zlib.crc32(text[i:i + SHINGLE_SIZE].encode("utf-8"))
+            for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text):  # {{{1
+    """ Return the MinHash signature of a text as an array of ints.
+
+    The array has NUM_PERMUTATIONS items. """
+
+    hashes = shingles(text)
+    if numpy is not None:
+        values = numpy.fromiter(hashes, dtype=numpy.uint64, count=len(hashes))
+        factors = numpy.array(
+            [a for a, _ in _PERMUTATIONS], dtype=numpy.uint64)
+        offsets = numpy.array(
+            [b for _, b in _PERMUTATIONS], dtype=numpy.uint64)
+        # reduce x first so that a*x stays below 2**62
+        values %= _PRIME
+        products = factors[:, None] * values[None, :] + offsets[:, None]
+        mins = (products % _PRIME).min(axis=1)
+        return array("I", mins.astype(numpy.uint32).tobytes())
+    hashes = [value % _PRIME for value in hashes]
+    return array("I", (min((a * x + b) % _PRIME for x in hashes)
+                       for a, b in _PERMUTATIONS))
+
+
+def similarity(signature1, signature2):  # {{{1
+    """ Estimate the Jaccard similarity of two texts from their signatures. """
+
+    equal = sum(1 for a, b in zip(signature1, signature2) if a == b)
+    return equal / NUM_PERMUTATIONS
+
+
+class NearDuplicateFinder:  # {{{1
+    """ Find clusters of taglines whose texts are nearly the same. """
+
+    def __init__(self, db, threshold=0.7, batch_size=1000):  # {{{2
+        self.db = db
+        self.threshold = threshold
+        self.batch_size = batch_size
+
+    def update_signatures(self, progress=True):  # {{{2
+        """ Compute signatures of all texts that are new or have changed.
+
+        Returns the number of computed signatures. """
+
+        self.db.execute(
+            "DELETE FROM signatures WHERE line NOT IN (SELECT id FROM lines)")
+        cursor = self.db.execute(
+            """SELECT l.id, l.hash, unpack_text(l.text) FROM lines AS l
+            LEFT JOIN signatures AS s ON s.line=l.id
+            WHERE s.hash IS NOT l.hash""")
+        rows = cursor.fetchall()
+
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            self.db.db.executemany(
+                """INSERT OR REPLACE INTO signatures (line, hash, minhash)
+                VALUES (?,?,?)""",
+                ((line, text_hash, minhash(text or "").tobytes())
+                 for line, text_hash, text in batch))
+            self.db.commit()
+            if progress:
+                print(f"\rComputed {start + len(batch)}/{len(rows)} "
+                      "signatures", end="", file=stderr)
+        if progress and rows:
+            print(file=stderr)
+        self.db.commit()
+        return len(rows)
+
+    def clusters(self):  # {{{2
+        """ Return a list of clusters, each a sorted list of tagline IDs. """
+
+        self.update_signatures()
+
+        signatures = {}
+        taglines = {}
+        buckets = {}
+        rows_per_band = NUM_PERMUTATIONS // BANDS
+        cursor = self.db.execute(
+            """SELECT s.line, l.tagline, s.minhash FROM signatures AS s
+            JOIN lines AS l ON l.id=s.line""")
+        for line, tagline, blob in cursor:
+            signature = array("I")
+            signature.frombytes(blob)
+            signatures[line] = signature
+            taglines[line] = tagline
+            for band in range(BANDS):
+                start = band * rows_per_band
+                key = (band, tuple(signature[start:start + rows_per_band]))
+                buckets.setdefault(key, []).append(line)
+
+        # union-find over taglines
+        parent = {}
+
+        def find(tagline):
+            while parent.get(tagline, tagline) != tagline:
+                parent[tagline] = parent.get(parent[tagline], parent[tagline])
+                tagline = parent[tagline]
+            return tagline
+
+        for lines in buckets.values():
+            if len(lines) < 2:
+                continue
+            for i, line1 in enumerate(lines):
+                for line2 in lines[i + 1:]:
+                    root1, root2 = find(taglines[line1]), find(taglines[line2])
+                    # already known to belong together
+                    if root1 == root2:
+                        continue
+                    if similarity(signatures[line1], signatures[line2]) \
+                            >= self.threshold:
+                        parent[root1] = root2
+
+        clusters = {}
+        for tagline in set(parent) | set(parent.values()):
+            clusters.setdefault(find(tagline), set()).add(tagline)
+        return sorted(sorted(cluster) for cluster in clusters.values())
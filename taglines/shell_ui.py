@@ -7,7 +7,7 @@ import subprocess
 import tempfile
 from datetime import datetime
 
-from taglines.database import DatabaseTagline
+from taglines.database import DatabaseTagline, search_text
 
 # pylint: disable=line-too-long
 
@@ -213,6 +213,15 @@ class ShellUI:  # {{{1 interactive mode
         if i and "yes".startswith(i.lower()):
             raise ShellUI.ExitShellUI()
 
+    def print_suggestions(self, table, needle):  # {{{1
+        """ Print the best matching authors or keywords with their IDs. """
+
+        matches = self.db.find_names(table, needle)
+        if matches:
+            print("Did you mean:")
+            for row_id, name in matches:
+                print(f"{row_id:>4}: {name}")
+
     def author_menu(self, breadcrumbs):  # {{{1
         """ The menu with which to alter author information. """
 
@@ -251,8 +260,8 @@ class ShellUI:  # {{{1 interactive mode
                         died = None
                     try:
                         cursor = self.db.execute(
-                            "INSERT INTO authors (name, born, died) VALUES (?,?,?)", (
-                                name, born, died), True)
+                            "INSERT INTO authors (name, born, died, search) VALUES (?,?,?,?)", (
+                                name, born, died, search_text(name)), True)
                         print(f"Author added, new ID is {cursor.lastrowid}")
                     except sqlite3.Error as error:
                         print("An sqlite3 error occurred:", error.args[0])
@@ -260,7 +269,7 @@ class ShellUI:  # {{{1 interactive mode
             elif choice == "c":
                 if author_id is None:
                     author_id = self.get_input(
-                        "\nID of new current author (empty to abort, 'u' to unset): ",
+                        "\nID or name of new current author (empty to abort, 'u' to unset): ",
                         allow_int=True)
                     if author_id == "":
                         continue
@@ -269,8 +278,13 @@ class ShellUI:  # {{{1 interactive mode
                         print("Current author unset.")
                         continue
                     if not isinstance(author_id, int):
-                        print("Error: not an integer ID.")
-                        continue
+                        # an author name was given
+                        matches = self.db.find_names("authors", author_id)
+                        if len(matches) != 1 or search_text(author_id) not in search_text(matches[0][1]):
+                            print("Error: no unique author name.")
+                            self.print_suggestions("authors", author_id)
+                            continue
+                        author_id = matches[0][0]
                 row = self.db.get_one("SELECT id, name FROM authors WHERE id=?", (author_id,))
                 if row is None:
                     print(f"Author with ID {author_id} does not exist.")
@@ -344,7 +358,7 @@ class ShellUI:  # {{{1 interactive mode
                 if text:
                     try:
                         cursor = self.db.execute(
-                            "INSERT INTO keywords (text) VALUES (?)", (text,), True)
+                            "INSERT INTO keywords (text, search) VALUES (?,?)", (text, search_text(text)), True)
                         keyword = cursor.lastrowid()
                         print("Keyword added, new ID is", keyword)
                         deleted_keywords.discard(keyword)
@@ -413,14 +427,16 @@ class ShellUI:  # {{{1 interactive mode
 
             else:
                 if not choice == "t":
-                    # a keyword name was given
-                    cursor = self.db.execute("SELECT id FROM keywords WHERE text LIKE ?", (choice + '%',))
-                    rows = cursor.fetchall()
-                    if len(rows) == 0:
-                        print("Error: no valid keyword name.")
-                        continue
-                    if len(rows) > 1:
-                        print("Error: multiple matches.")
+                    # a keyword name was given; an exact match wins over
+                    # other keywords containing it
+                    folded = search_text(choice)
+                    rows = [row for row in self.db.find_names("keywords", choice)
+                            if folded in search_text(row[1])]
+                    if rows and search_text(rows[0][1]) == folded:
+                        rows = rows[:1]
+                    if len(rows) != 1:
+                        print("Error: no valid keyword name." if len(rows) == 0 else "Error: multiple matches.")
+                        self.print_suggestions("keywords", choice)
                         continue
                     keyword = rows[0][0]
 
@@ -461,7 +477,7 @@ class ShellUI:  # {{{1 interactive mode
                 output.append(str("keywords: " + ", ".join(keywords)))
             print(f"#{row[0]:>5}{': ' + ', '.join(output) if output else ''}")
             sub = self.db.execute(
-                "SELECT l.id, l.date, language, text FROM lines l "
+                "SELECT l.id, l.date, language, unpack_text(text) FROM lines l "
                 "LEFT JOIN taglines t ON l.tagline = t.id WHERE t.id=?", (row[0],))
             for keyword in sub:
                 # pylint: disable=consider-using-f-string
@@ -473,6 +489,16 @@ class ShellUI:  # {{{1 interactive mode
         if not found:
             print("No match found.")
 
+    def confirm_unique_text(self, text, tagline_id=None):  # {{{1
+        """ Warn if the text exists elsewhere and ask whether to keep it. """
+
+        others = [other for other in self.db.find_text(text) if other != tagline_id]
+        if not others:
+            return True
+        self.print_warning(
+            f"    This text already exists in tagline {', '.join(str(other) for other in others)}.")
+        return self.ask_yesno("    Use it anyway?", "n") == "y"
+
     def taglines_menu(self, breadcrumbs):  # {{{1
         """ The menu with which to alter the actual taglines. """
 
@@ -511,9 +537,8 @@ class ShellUI:  # {{{1 interactive mode
 
                 try:
                     if self.db.get_one("SELECT id FROM taglines WHERE id=?", (tagline,)):
-                        self.db.execute("DELETE FROM kw_tl WHERE tagline=?", (tagline,))
-                        self.db.execute("DELETE FROM lines WHERE tagline=?", (tagline,))
-                        self.db.execute('DELETE FROM taglines WHERE id=?', (tagline,), commit=True)
+                        DatabaseTagline(self.db, tagline).delete()
+                        self.db.commit()
                         print(f"Tagline {tagline} and all its keyword assignments deleted.")
                     else:
                         print("Tagline with given ID does not exist.")
@@ -575,12 +600,7 @@ class ShellUI:  # {{{1 interactive mode
                 if needle == "":
                     continue
 
-                query = """SELECT tl.id FROM taglines AS tl JOIN lines AS l ON
-                l.tagline=tl.id WHERE text like ?"""
-                cursor = self.db.execute(query, (f"%{needle}%",))
-                ids = []
-                for row in cursor:
-                    ids.append(row[0])
+                ids = self.db.search(needle)
                 query = f"""SELECT t.id, a.name, source, remark, date FROM taglines AS t
                 LEFT JOIN authors AS a ON t.author=a.id WHERE t.id IN ({",".join([str(i) for i in ids])})"""
                 self.print_search_result(query)
@@ -741,7 +761,7 @@ class ShellUI:  # {{{1 interactive mode
 
             if choice == "a":
                 result = enter_text("ENTER A NEW ITEM", existing_langs=tagline.texts)
-                if result is not None:
+                if result is not None and self.confirm_unique_text(result[1], tagline.id):
                     tagline.set_text(*result)
 
             elif choice == "m":
@@ -784,7 +804,7 @@ class ShellUI:  # {{{1 interactive mode
 
                         if lang in tagline.texts:
                             result = enter_text("EDIT TEXT", lang, tagline.texts, existing_text=tagline.texts[lang][0])
-                            if result is not None:
+                            if result is not None and self.confirm_unique_text(result[1], tagline.id):
                                 tagline.set_text(*result, old_language=lang)
                         else:
                             print("Invalid language.")
@@ -0,0 +1,187 @@
+""" Compact read-only snapshot of a database for fast random selection.
+
+A snapshot file contains all texts of a database together with the line
+indices per language and per keyword. It is accessed through mmap, so picking
+a random text neither needs sqlite nor reads more of the file than necessary.
+
+File layout (all numbers little endian):
+    header:     magic, number of lines, number of languages, number of keywords
+    offsets:    (lines + 1) * uint64, start of each text in the text blob
+    directory:  per language, then per keyword: uint16 name length, name,
+                uint32 start and uint32 length of its range in the index pool
+    pool:       uint32 line indices, ascending within each range
+    texts:      UTF-8 text blob
+"""
+
+import mmap
+import os
+import random
+import struct
+from bisect import bisect_left
+
+_MAGIC = b"TGLSNAP1"
+_HEADER = struct.Struct("<8sIII")
+_ENTRY = struct.Struct("<II")
+_NAME_LENGTH = struct.Struct("<H")
+# how often to try picking from the smallest set before intersecting fully
+_MAX_ATTEMPTS = 64
+
+
+def default_path(dbfilename):  # {{{1
+    """ Return the path of the snapshot which is used automatically. """
+
+    return dbfilename + ".snapshot"
+
+
+def write_snapshot(db, path):  # {{{1
+    """ Write the contents of the given Database to a snapshot file. """
+
+    ids = []
+    texts = []
+    for line_id, text in db.execute(
+            "SELECT id, unpack_text(text) FROM lines ORDER BY id"):
+        ids.append(line_id)
+        texts.append((text or "").encode("utf-8"))
+    index = {line_id: position for position, line_id in enumerate(ids)}
+
+    def ranges(query):
+        groups = {}
+        for name, line_id in db.execute(query):
+            groups.setdefault(name, []).append(index[line_id])
+        return groups
+
+    languages = ranges(
+        """SELECT language, id FROM lines WHERE language IS NOT NULL
+        ORDER BY id""")
+    keywords = ranges(
+        """SELECT k.text, l.id FROM keywords AS k
+        JOIN kw_tl AS kt ON kt.keyword=k.id
+        JOIN lines AS l ON l.tagline=kt.tagline ORDER BY l.id""")
+
+    directory = b""
+    pool = []
+    for groups in (languages, keywords):
+        for name, positions in groups.items():
+            encoded = name.encode("utf-8")
+            directory += _NAME_LENGTH.pack(len(encoded)) + encoded
+            directory += _ENTRY.pack(len(pool), len(positions))
+            pool.extend(positions)
+
+    offsets = [0]
+    for text in texts:
+        offsets.append(offsets[-1] + len(text))
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as handle:
+        handle.write(_HEADER.pack(
+            _MAGIC, len(texts), len(languages), len(keywords)))
+        handle.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        handle.write(directory)
+        handle.write(struct.pack(f"<{len(pool)}I", *pool))
+        for text in texts:
+            handle.write(text)
+    os.replace(temp_path, path)
+    return len(texts)
+
+
+class Snapshot:  # {{{1
+    """ Memory-mapped reader of a snapshot file. """
+
+    class SnapshotError(Exception):  # {{{2
+        """ Exception that is thrown if a file is not a valid snapshot. """
+
+    def __init__(self, path):  # {{{2
+        with open(path, "rb") as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+
+        magic, count, language_count, keyword_count = _HEADER.unpack_from(view)
+        if magic != _MAGIC:
+            raise Snapshot.SnapshotError(f"{path} is not a taglines snapshot.")
+        position = _HEADER.size
+        self._offsets = view[position:position + 8 * (count + 1)].cast("Q")
+        position += 8 * (count + 1)
+
+        entries = []
+        for _ in range(language_count + keyword_count):
+            length, = _NAME_LENGTH.unpack_from(view, position)
+            position += _NAME_LENGTH.size
+            name = bytes(view[position:position + length]).decode("utf-8")
+            position += length
+            entries.append((name, _ENTRY.unpack_from(view, position)))
+            position += _ENTRY.size
+        pool_size = sum(length for _, (_, length) in entries)
+        pool = view[position:position + 4 * pool_size].cast("I")
+        self._texts = view[position + 4 * pool_size:]
+
+        self.languages = {}
+        self.keywords = {}
+        for number, (name, (start, length)) in enumerate(entries):
+            if number < language_count:
+                target = self.languages
+            else:
+                target = self.keywords
+            target[name] = pool[start:start + length]
+        self.count = count
+
+    def close(self):  # {{{2
+        """ Release the memory map. """
+
+        self.languages = self.keywords = None
+        self._offsets = self._texts = None
+        self._map.close()
+
+    def text(self, position):  # {{{2
+        """ Return the text at the given position. """
+
+        start = self._offsets[position]
+        return str(self._texts[start:self._offsets[position + 1]], "utf-8")
+
+    def candidates(self, language=None, keywords=None,
+                   keywords_or=False):  # {{{2
+        """ Return the sets of positions of which a match must be a member.
+
+        Every returned sequence is sorted. None means no restriction at all,
+        an empty list means that nothing can match. """
+
+        sets = []
+        if language is not None:
+            sets.append(self.languages.get(language, []))
+        if keywords:
+            if keywords_or:
+                merged = set()
+                for keyword in keywords:
+                    merged.update(self.keywords.get(keyword, []))
+                sets.append(sorted(merged))
+            else:
+                sets.extend(
+                    self.keywords.get(keyword, []) for keyword in keywords)
+        if not sets:
+            return None
+        return sorted(sets, key=len)
+
+    def random_tagline(self, language=None, keywords=None,
+                       keywords_or=False):  # {{{2
+        """ Return a random text matching the filters, or None. """
+
+        sets = self.candidates(language, keywords, keywords_or)
+        if sets is None:
+            if not self.count:
+                return None
+            return self.text(random.randrange(self.count))
+
+        def contains(positions, position):
+            index = bisect_left(positions, position)
+            return index < len(positions) and positions[index] == position
+
+        smallest, others = sets[0], sets[1:]
+        if not smallest:
+            return None
+        for _ in range(_MAX_ATTEMPTS):
+            position = smallest[random.randrange(len(smallest))]
+            if all(contains(other, position) for other in others):
+                return self.text(position)
+
+        matches = [position for position in smallest
+                   if all(contains(other, position) for other in others)]
+        return self.text(random.choice(matches)) if matches else None
@@ -0,0 +1,121 @@
+""" Replication of database changes between copies of a database.
+
+The change log records the table and ID of every inserted, updated or deleted
+row. An export contains the current state of every row changed after a given
+change ID, so applying it to a replica takes time proportional to the number
+of edits instead of the size of the database.
+
+Exports are newline-delimited JSON: a header object with the schema version
+and the range of exported change IDs, followed by one object per row. """
+
+import json
+import sqlite3
+
+from taglines.database import LOGGED_TABLES, NAME_INDEXES, Database
+
+# columns besides the ID whose values are unique
+_UNIQUE_COLUMNS = {"keywords": "text"}
+
+
+def export_changes(db, since, handle):  # {{{1
+    """ Write all rows changed after change ID since to the file handle.
+
+    Returns the ID of the last exported change, to be used as the next
+    since. """
+
+    until = db.get_one("SELECT max(id) FROM changes")[0] or since
+    handle.write(json.dumps({
+        "schema": db.get_version(), "since": since, "until": until}) + "\n")
+
+    cursor = db.execute(
+        """SELECT tbl, row FROM changes WHERE id>? AND id<=?
+        GROUP BY tbl, row ORDER BY max(id)""", (since, until))
+    for table, row_id in cursor.fetchall():
+        row = db.execute(f"SELECT * FROM {table} WHERE id=?", (row_id,))
+        columns = [column[0] for column in row.description]
+        values = row.fetchone()
+        if values is None:
+            item = {"table": table, "id": row_id, "deleted": True}
+        else:
+            values = dict(zip(columns, values))
+            if table == "lines":
+                # replicas may store their texts compressed differently
+                values["text"] = db.unpack_text(values["text"])
+            item = {"table": table, "id": row_id, "row": values}
+        handle.write(json.dumps(item, default=str) + "\n")
+    return until
+
+
+def _check_indexes(db):  # {{{1
+    """ Raise a DatabaseError if a full-text index differs from its table. """
+
+    indexes = [index for _, index in NAME_INDEXES.values()]
+    for index in ["lines_search"] + indexes:
+        if not db.has_table(index):
+            continue
+        try:
+            db.execute(f"INSERT INTO {index} ({index}, rank) "
+                       "VALUES ('integrity-check', 1)")
+        except sqlite3.DatabaseError as error:
+            raise Database.DatabaseError(
+                f"The index {index} is inconsistent after applying "
+                f"the changes: {error}") from error
+
+
+def apply_changes(db, handle):  # {{{1
+    """ Apply an export read from the file handle in one transaction.
+
+    Returns the number of applied rows. """
+
+    header = json.loads(handle.readline() or "{}")
+    if header.get("schema") != db.get_version():
+        raise Database.DatabaseError(
+            f"The changes are for schema version {header.get('schema')}, "
+            f"but the database has version {db.get_version()}.")
+
+    known_columns = {}
+    count = 0
+    db.execute("BEGIN")
+    try:
+        for line in handle:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            table = item["table"]
+            if table not in LOGGED_TABLES:
+                raise Database.DatabaseError(
+                    f"Unknown table in changes: {table}")
+            if item.get("deleted"):
+                db.execute(f"DELETE FROM {table} WHERE id=?", (item["id"],))
+            else:
+                if table not in known_columns:
+                    known_columns[table] = {
+                        row[1] for row in
+                        db.execute(f"PRAGMA table_info({table})")}
+                row = item["row"]
+                unknown = set(row) - known_columns[table]
+                if unknown:
+                    raise Database.DatabaseError(
+                        f"Unknown columns in changes for {table}: "
+                        f"{', '.join(sorted(unknown))}")
+                if table == "lines" and row.get("text") is not None:
+                    row["text"] = db.pack_text(row["text"])
+                # INSERT OR REPLACE would not fire the delete triggers, which
+                # keep the full-text indexes in sync
+                db.execute(f"DELETE FROM {table} WHERE id=?", (item["id"],))
+                if table in _UNIQUE_COLUMNS:
+                    # the row holding the value has another change later on
+                    column = _UNIQUE_COLUMNS[table]
+                    db.execute(f"DELETE FROM {table} WHERE {column}=?",
+                               (row.get(column),))
+                db.execute(
+                    f"INSERT INTO {table} ({', '.join(row)}) "
+                    f"VALUES ({', '.join('?' * len(row))})",
+                    tuple(row.values()))
+            count += 1
+        _check_indexes(db)
+    except (sqlite3.Error, Database.DatabaseError, KeyError, ValueError):
+        db.rollback()
+        raise
+    db.commit()
+    return count
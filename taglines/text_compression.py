@@ -0,0 +1,266 @@
+""" Optional compressed storage of the texts of lines.
+
+Taglines are short, so compressing each text on its own gains little; what
+makes it worthwhile is a dictionary shared by all texts, trained from a sample
+of them and stored in the status table. A compressed text is a BLOB in
+lines.text, starting with a header of the codec and the ID of the dictionary,
+while uncompressed texts stay TEXT, so both kinds can be mixed freely. Texts
+that do not get smaller are always kept uncompressed.
+
+Readers decode the column with the SQL function unpack_text(), which every
+connection of a Database provides, and writers encode it with
+Database.pack_text(). Searching is not affected, since it uses the search
+column and its full-text index. """
+
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from sys import stderr
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# zlib can refer back at most 32 KiB, which includes its preset dictionary
+DICTIONARY_SIZE = 16384
+# the codec's mark and the ID of the dictionary in front of every compressed
+# text
+_HEADER = struct.Struct("<cI")
+_MARKS = {"zlib": b"z", "zstd": b"s"}
+# words including the punctuation and whitespace that follow them
+_WORD = re.compile(r"\w+\W*|\W+")
+
+
+def codecs():  # {{{1
+    """ Return the names of the available codecs, the preferred one first. """
+
+    return ["zstd", "zlib"] if zstandard is not None else ["zlib"]
+
+
+def dictionary_id(stored):  # {{{1
+    """ Return the ID of the dictionary a text was compressed with. """
+
+    return _HEADER.unpack_from(stored)[1]
+
+
+def train_dictionary(texts, size=DICTIONARY_SIZE, codec="zlib"):  # {{{1
+    """ Return a dictionary of the strings that are most common in the texts.
+
+    zstd trains its own; for zlib, which simply uses the dictionary as text
+    preceding the data, words and pairs of words are ranked by the bytes they
+    would save. Nearer matches are encoded more cheaply, so the most valuable
+    strings are placed at the end. """
+
+    if codec == "zstd":
+        samples = [text.encode("utf-8") for text in texts]
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            # too few samples; zstd also accepts plain content as dictionary
+            pass
+
+    counts = Counter()
+    for text in texts:
+        words = _WORD.findall(text)
+        counts.update(words)
+        counts.update(first + second
+                      for first, second in zip(words, words[1:]))
+
+    chosen = []
+    total = 0
+    scores = ((string, (count - 1) * len(string.encode("utf-8")))
+              for string, count in counts.items()
+              if count > 1 and len(string) > 2)
+    for string, _ in sorted(scores, key=lambda item: item[1], reverse=True):
+        length = len(string.encode("utf-8"))
+        if total + length > size:
+            continue
+        chosen.append(string)
+        total += length
+    return "".join(reversed(chosen)).encode("utf-8")
+
+
+class TextCodec:  # {{{1
+    """ Compression of texts with one codec and dictionary. """
+
+    def __init__(self, name, dictionary):  # {{{2
+        if name not in _MARKS:
+            raise ValueError(f"Unknown codec: {name}")
+        if name == "zstd" and zstandard is None:
+            raise ValueError("The zstd codec needs the zstandard module.")
+        self.name = name
+        self.dictionary = bytes(dictionary)
+        self.id = zlib.crc32(self.dictionary)
+        self._header = _HEADER.pack(_MARKS[name], self.id)
+        if name == "zstd":
+            data = zstandard.ZstdCompressionDict(self.dictionary)
+            self._compressor = zstandard.ZstdCompressor(
+                level=19, dict_data=data, write_dict_id=False)
+            self._decompressor = zstandard.ZstdDecompressor(dict_data=data)
+            # neither of them may be used by two threads at once
+            self._lock = threading.Lock()
+
+    def compress(self, text):  # {{{2
+        """ Return the value to store for a text: compressed bytes, or the text
+        itself if compression does not make it smaller. """
+
+        data = text.encode("utf-8")
+        if self.name == "zlib":
+            # raw deflate, as the header's dictionary ID replaces zlib's own
+            compressor = zlib.compressobj(
+                9, zlib.DEFLATED, -15, zdict=self.dictionary)
+            payload = compressor.compress(data) + compressor.flush()
+        else:
+            with self._lock:
+                payload = self._compressor.compress(data)
+        stored = self._header + payload
+        return stored if len(stored) < len(data) else text
+
+    def decompress(self, stored):  # {{{2
+        """ Return the text of a value returned by compress(). """
+
+        payload = memoryview(stored)[_HEADER.size:]
+        if self.name == "zlib":
+            decompressor = zlib.decompressobj(-15, zdict=self.dictionary)
+            data = decompressor.decompress(payload) + decompressor.flush()
+        else:
+            with self._lock:
+                data = self._decompressor.decompress(payload)
+        return data.decode("utf-8")
+
+
+def _rewrite(db, convert, condition, chunk_size, progress):  # {{{1
+    """ Store convert(text) for the texts of all lines matching the condition.
+
+    The lines are processed in chunks of ascending ID, each in its own
+    transaction like a Backfill. Only the storage changes, not the content,
+    so the change log entries caused by the rewrite are removed again; else
+    the next export for a replica would contain every text. Returns the
+    number of rewritten lines and their size in bytes before and after. """
+
+    total = db.get_one(
+        f"SELECT count(*) FROM lines WHERE {condition}")[0]
+    last_id = 0
+    done = 0
+    result = {"lines": 0, "bytes before": 0, "bytes after": 0}
+    while True:
+        db.execute("BEGIN")
+        rows = db.execute(
+            f"SELECT id, text FROM lines WHERE id>? AND {condition} "
+            "ORDER BY id LIMIT ?",
+            (last_id, chunk_size)).fetchall()
+        if not rows:
+            db.commit()
+            break
+        updates = []
+        for line_id, value in rows:
+            stored = convert(db.unpack_text(value))
+            if type(stored) is not type(value) or stored != value:
+                updates.append((stored, line_id))
+                result["bytes before"] += _stored_size(value)
+                result["bytes after"] += _stored_size(stored)
+        last_change = db.get_one("SELECT max(id) FROM changes")[0] or 0
+        db.db.executemany("UPDATE lines SET text=? WHERE id=?", updates)
+        db.execute("DELETE FROM changes WHERE id>?", (last_change,))
+        db.commit()
+        result["lines"] += len(updates)
+        last_id = rows[-1][0]
+        done += len(rows)
+        if progress:
+            print(f"\r  lines: {done}/{total}", end="", file=stderr)
+    if progress and total:
+        print(file=stderr)
+    return result
+
+
+def _stored_size(value):  # {{{1
+    """ Return the number of bytes a value of lines.text takes. """
+
+    if isinstance(value, bytes):
+        return len(value)
+    return len((value or "").encode("utf-8"))
+
+
+def compress_texts(db, codec=None, sample_size=2000, chunk_size=5000,
+                   progress=True):  # {{{1
+    """ Enable compression of the database's texts and compress the existing
+    ones.
+
+    The first time, a dictionary is trained from a random sample of texts with
+    the given codec, by default the preferred one of codecs(). Afterwards new
+    and changed texts are compressed when written, and calling this again
+    compresses those that were written by other programs in the meantime.
+    Returns the result of _rewrite() plus the codec and the seconds taken. """
+
+    start = time.monotonic()
+    current = db.text_codec
+    if current is not None and codec is not None and current.name != codec:
+        raise db.DatabaseError(
+            f"The texts are already compressed with {current.name}; "
+            "decompress them first to change the codec.")
+    if current is None:
+        codec = codec or codecs()[0]
+        if progress:
+            print(f"Training a {codec} dictionary...", file=stderr)
+        texts = [row[0] for row in db.execute(
+            "SELECT unpack_text(text) FROM lines ORDER BY random() LIMIT ?",
+            (sample_size,))]
+        db.execute("BEGIN")
+        db.set_text_codec(
+            TextCodec(codec, train_dictionary(texts, codec=codec)))
+        db.commit()
+    if progress:
+        print("Compressing texts...", file=stderr)
+    result = _rewrite(
+        db, db.pack_text, "typeof(text)='text'", chunk_size, progress)
+    result["codec"] = db.text_codec.name
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def decompress_texts(db, chunk_size=5000, progress=True):  # {{{1
+    """ Store all texts uncompressed again and disable compression.
+
+    Returns the result of _rewrite() plus the seconds taken. """
+
+    start = time.monotonic()
+    if progress:
+        print("Decompressing texts...", file=stderr)
+    result = _rewrite(db, str, "typeof(text)='blob'", chunk_size, progress)
+    # the dictionary is only dropped together with the last compressed texts,
+    # which another program may have written during the rewrite
+    db.execute("BEGIN")
+    rest = db.execute(
+        "SELECT id, text FROM lines WHERE typeof(text)='blob'").fetchall()
+    db.db.executemany(
+        "UPDATE lines SET text=? WHERE id=?",
+        ((db.unpack_text(value), line_id) for line_id, value in rest))
+    db.set_text_codec(None)
+    db.commit()
+    result["lines"] += len(rest)
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def storage_report(db):  # {{{1
+    """ Return the number of lines, how many of them are compressed, the size
+    of their texts in bytes uncompressed and as stored, and the seconds it
+    takes to read and decode all of them. """
+
+    lines, compressed, plain, stored = db.get_one(
+        """SELECT count(*), total(typeof(text)='blob'),
+        total(length(CAST(unpack_text(text) AS BLOB))),
+        total(length(CAST(text AS BLOB)))
+        FROM lines""")
+    start = time.monotonic()
+    for _ in db.execute("SELECT unpack_text(text) FROM lines"):
+        pass
+    return {
+        "lines": lines, "compressed": int(compressed),
+        "bytes": int(plain), "bytes stored": int(stored),
+        "read seconds": time.monotonic() - start,
+    }
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+""" Load test of the event-loop latency with AsyncDatabase.
+
+Usage: tools/async_latency.py DATABASE [REQUESTS]
+
+While a number of random_tagline() requests run concurrently, a ticker task
+measures by how much its 1 ms sleeps are delayed, i.e. how long the event
+loop is blocked. For comparison, the same requests are also made by calling
+Database directly from the event loop. """
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from taglines.async_database import AsyncDatabase  # noqa: E402
+from taglines.database import Database  # noqa: E402
+
+TICK = 0.001
+
+
+async def ticker(delays, done):  # {{{1
+    """ Record the delay of every tick until done is set. """
+
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        delays.append(time.perf_counter() - start - TICK)
+
+
+async def measure(requests):  # {{{1
+    """ Run the requests concurrently with a ticker and return the delays
+    and seconds. """
+
+    delays = []
+    done = asyncio.Event()
+    tick = asyncio.create_task(ticker(delays, done))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*requests)
+    seconds = time.perf_counter() - start
+    done.set()
+    await tick
+    return delays, seconds
+
+
+def report(title, count, delays, seconds):  # {{{1
+    """ Print the throughput and the distribution of the loop delays. """
+
+    delays = sorted(delays) or [0]
+    print(f"{title:>26}: {count / seconds:8.0f} requests/s, loop delay "
+          f"median {statistics.median(delays) * 1000:6.2f} ms, "
+          f"p99 {delays[int(len(delays) * 0.99)] * 1000:6.2f} ms, "
+          f"max {delays[-1] * 1000:6.2f} ms")
+
+
+async def main(path, count):  # {{{1
+    for concurrency in (1, 8, 32):
+        async with AsyncDatabase(path, max_pending=concurrency) as adb:
+            await adb.random_tagline()
+            delays, seconds = await measure(
+                adb.random_tagline() for _ in range(count))
+            report(f"AsyncDatabase, {concurrency} pending",
+                   count, delays, seconds)
+
+    db = Database(path)
+
+    async def blocking():
+        db.random_tagline()
+
+    delays, seconds = await measure(blocking() for _ in range(count))
+    report("Database in the loop", count, delays, seconds)
+    db.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__.split("\n\n")[1])
+    asyncio.run(main(sys.argv[1],
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 2000))
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+""" Benchmark of keyword expressions with and without the kw_tl index.
+
+Usage: tools/keyword_expression_benchmark.py [TAGLINES [KEYWORDS
+                                              [ASSIGNMENTS]]]
+
+Builds a temporary database with the given numbers of taglines, keywords and
+keyword assignments, where a few keywords are much more common than the rest,
+as in real collections. Then the queries of a set of nested AND/OR/NOT
+expressions are timed, once with the (keyword, tagline) index on kw_tl and
+once after dropping it. """
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from taglines import keyword_expression  # noqa: E402
+from taglines.database import Database  # noqa: E402
+
+EXPRESSIONS = [
+    "k1 AND k2",
+    "(k1 OR k2) AND NOT k3",
+    "(k1 OR k2 OR k3) AND (k4 OR k5) AND NOT (k6 OR k7)",
+    "((k1 OR k2) AND (k3 OR k4 OR k5)) AND NOT (k6 AND k7) "
+    "AND NOT (k8 OR k9)",
+    "NOT (k10 OR (k11 AND NOT k12))",
+]
+REPEATS = 5
+
+
+def build(db, taglines, keywords, assignments):  # {{{1
+    """ Fill the database with taglines and random keyword assignments. """
+
+    assignments = min(assignments, taglines * keywords)
+    rng = random.Random(1)
+    db.execute("BEGIN")
+    db.db.executemany("INSERT INTO taglines (id) VALUES (?)",
+                      ((number,) for number in range(1, taglines + 1)))
+    db.db.executemany("INSERT INTO keywords (id, text) VALUES (?,?)",
+                      ((number, f"k{number}")
+                       for number in range(1, keywords + 1)))
+    # keyword n is chosen with a weight of 1/n
+    weights = [1 / number for number in range(1, keywords + 1)]
+    pairs = set()
+    while len(pairs) < assignments:
+        pairs.update(zip(
+            rng.choices(range(1, keywords + 1), weights,
+                        k=assignments - len(pairs)),
+            rng.choices(range(1, taglines + 1), k=assignments - len(pairs))))
+    db.db.executemany("INSERT INTO kw_tl (keyword, tagline) VALUES (?,?)",
+                      sorted(pairs, key=lambda pair: pair[1]))
+    # the change log is of no interest here
+    db.execute("DELETE FROM changes")
+    db.commit()
+    db.execute("ANALYZE")
+    db.commit()
+
+
+def measure(db):  # {{{1
+    """ Return the number of matches and the best time in seconds of each
+    expression. """
+
+    results = []
+    for expression in EXPRESSIONS:
+        query, qargs = keyword_expression.compile_sql(
+            keyword_expression.parse(expression))
+        best = None
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            count = db.get_one(f"SELECT count(*) FROM ({query})", qargs)[0]
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        results.append((count, best))
+    return results
+
+
+def main(taglines, keywords, assignments):  # {{{1
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database()
+        db.initialise_file(os.path.join(directory, "benchmark.db"))
+        start = time.perf_counter()
+        build(db, taglines, keywords, assignments)
+        print(f"Built {taglines} taglines, {keywords} keywords and "
+              f"{assignments} assignments in "
+              f"{time.perf_counter() - start:.1f}s.")
+
+        indexed = measure(db)
+        db.execute("DROP INDEX kw_tl_keyword")
+        db.commit()
+        unindexed = measure(db)
+        db.close()
+
+    print(f"{'matches':>8} {'index':>9} {'no index':>9}  expression")
+    for expression, (count, fast), (_, slow) in zip(
+            EXPRESSIONS, indexed, unindexed):
+        print(f"{count:8d} {fast * 1000:7.1f}ms {slow * 1000:7.1f}ms  "
+              f"{expression}")
+
+
+if __name__ == "__main__":
+    arguments = [int(argument) for argument in sys.argv[1:4]]
+    main(*arguments + [200000, 500, 1000000][len(arguments):])